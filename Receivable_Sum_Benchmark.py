@@ -0,0 +1,185 @@
+"""
+Stage level benchmark of the receivables confirmation pipeline.
+
+Each stage of a confirmation round is timed on its own at increasing
+numbers of debtors, and its throughput and peak memory are recorded. The
+stages are named after the client function they time: create_network,
+make_random_shares_batch, schedule_distribution, aggregation (feeding the
+ShareAccumulator), the all_shares export, journaling the payloads, the
+agg_shares export, upload, download and recover_secret. Exports and the
+journal are written to a temporary directory. The upload and download
+stages run against the in memory simulator of the smart contract so no
+blockchain is needed.
+
+Results are written as JSON so runs can be compared across commits.
+
+$ python Receivable_Sum_Benchmark.py --debtors 1000 10000 100000
+"""
+
+from __future__ import print_function
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import Receivable_Sum_Client_Test as rs
+
+STAGES = ['create_network', 'make_random_shares_batch', 'schedule_distribution',
+          'aggregation', 'export_all_shares', 'journal', 'export_agg_shares',
+          'upload', 'download', 'recover_secret']
+
+
+def _commit():
+    """ Return the git commit being benchmarked, or None outside a repo """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _pipeline(n, seed, directory):
+    """ Return (stage, function) for each stage of a round with n debtors,
+        each function runs the stage on the results of the stages before
+        and writes its files to directory"""
+    state = {}
+
+    def create_network():
+        random.seed(seed)
+        state['bal'] = rs.create_network(n)
+
+    def make_random_shares_batch():
+        state['points'] = []
+        for start in range(0, n, rs._BATCH_SIZE):
+            state['points'].extend(rs.make_random_shares_batch(
+                state['bal'][start:start + rs._BATCH_SIZE],
+                minimum=rs.min_num_shares, shares=rs.num_shares))
+
+    def schedule_distribution():
+        state['schedule'] = list(rs.schedule_distribution(n, rs.num_shares))
+
+    def assignments():
+        """ Yield (recipient, share) for every share distributed, the
+            owner's kept share first as distribute_shares does"""
+        for shares_ls, (owner, share_to_keep, recipients) in zip(
+                state['points'], state['schedule']):
+            yield owner, shares_ls[share_to_keep]
+            others = shares_ls[:share_to_keep] + shares_ls[share_to_keep + 1:]
+            for bal_no, share in zip(recipients, others):
+                yield bal_no, share
+
+    def aggregation():
+        acc = rs.ShareAccumulator(n, rs.num_shares)
+        for bal_no, share in assignments():
+            acc.add(bal_no, share)
+        state['acc'] = acc
+
+    def export_all_shares():
+        with contextlib.closing(rs.open_share_writer(
+                os.path.join(directory, 'all_shares'), rs.ALL_SHARES_COLUMNS)) as out:
+            for bal_no, share in assignments():
+                out.writerow((bal_no,) + share)
+        del state['points'], state['schedule']
+
+    def journal():
+        journal = rs.RoundJournal(os.path.join(directory, 'journal.jsonl'))
+        journal.start(backend='simulator', num_receivables=n)
+        for id, shares in enumerate(state['acc'].payloads()):
+            journal.append({'record': 'payload', 'id': id, 'shares': shares})
+        journal.sync()
+        journal.close()
+
+    def export_agg_shares():
+        with contextlib.closing(rs.open_share_writer(
+                os.path.join(directory, 'agg_shares'), rs.AGG_SHARES_COLUMNS)) as out:
+            out.writerows(rs.payload_rows(state['acc'].payloads()))
+
+    def upload():
+        ledger = rs.SimulatedLedger(n)
+        with contextlib.redirect_stdout(io.StringIO()):
+            ledger.initialize_blockchain(
+                "Acme Corp", "31.12.19", sum(state['bal']), rs._PRIME,
+                rs.num_shares, rs.min_num_shares)
+        receipts, failures = ledger.upload_shares(state['acc'].payloads())
+        if failures:
+            raise RuntimeError('%d uploads failed' % len(failures))
+        state['ledger'] = ledger
+
+    def download():
+        state['shares_down'] = state['ledger'].download_cum_points(
+            rs.num_shares)
+
+    def recover_secret():
+        rs._lagrange_weights.cache_clear()
+        if rs.recover_secret(state['shares_down']) != sum(state['bal']):
+            raise RuntimeError('recovered secret does not match')
+
+    return zip(STAGES, [create_network, make_random_shares_batch,
+                        schedule_distribution, aggregation, export_all_shares,
+                        journal, export_agg_shares, upload, download,
+                        recover_secret])
+
+
+def run(n, seed, memory=True):
+    """ Benchmark each stage of a round with n debtors
+        Time is measured on one pass and peak memory, if memory, with
+        tracemalloc on a second pass so tracing does not skew the times
+        Return a list of result dicts, one per stage"""
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for stage, function in _pipeline(n, seed, directory):
+            start = time.perf_counter()
+            function()
+            seconds = time.perf_counter() - start
+            results.append({'debtors': n, 'stage': stage, 'seconds': seconds,
+                            'debtors_per_second': n / seconds if seconds else None,
+                            'peak_bytes': None})
+        if memory:
+            for result, (stage, function) in zip(results, _pipeline(n, seed, directory)):
+                tracemalloc.start()
+                function()
+                result['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--debtors', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--seed', type=int, default=31)
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the tracemalloc pass for peak memory')
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    report = {'commit': _commit(), 'python': platform.python_version(),
+              'num_shares': rs.num_shares, 'min_num_shares': rs.min_num_shares,
+              'seed': args.seed, 'results': []}
+    print('%8s %-24s %10s %14s %12s' % (
+        'debtors', 'stage', 'seconds', 'debtors/s', 'peak MiB'))
+    for n in args.debtors:
+        for result in run(n, args.seed, memory=not args.no_memory):
+            report['results'].append(result)
+            peak = result['peak_bytes']
+            print('%8d %-24s %10.3f %14.0f %12s' % (
+                n, result['stage'], result['seconds'],
+                result['debtors_per_second'] or 0,
+                '-' if peak is None else '%.1f' % (peak / 2 ** 20)))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Results written to', args.output)
+
+
+if __name__ == '__main__':
+    main()
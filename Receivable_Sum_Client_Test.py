@@ -41,36 +41,88 @@ aggregating this information on a blockchain.
 
 from __future__ import division
 from __future__ import print_function
+import array
+import contextlib
 import functools
+import itertools
+import operator
+import os
 import random
 import csv
-from web3 import Web3
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import json
+import mmap
 import time
+try:
+    import requests
+    from eth_account import Account
+    from hexbytes import HexBytes
+    from web3 import Web3
+    from web3.exceptions import TimeExhausted, TransactionNotFound
+except ImportError:
+    # web3 is only needed by the 'web3' ledger backend
+    Web3 = None
 
 # use same random numbers to create debtor's balances every run
 random.seed(31)
 
+# Ledger backend holding the smart contract, set RECEIVABLES_LEDGER to
+# 'web3' to run against ganache or 'simulator' to run it in memory
+ledger_backend = os.environ.get('RECEIVABLES_LEDGER', 'web3')
+
 # Connect to blockchain
 # Make sure ganache is running
 # $ ganache-cli --accounts 51 (num_recievables + 1 for owner account)
 
-print('Python Client initializing ...')
-# Wait for ganache to initialize
-time.sleep(30)
-
-
 # Uncomment next line if running in Docker compose
 ganache_url = 'HTTP://receivablessum-ganache-1:8545'
 # Uncomment next line if running ganache locally
 # ganache_url = 'HTTP://127.0.0.1:8545'
-web3 = Web3(Web3.HTTPProvider(ganache_url))
+ganache_url = os.environ.get('GANACHE_URL', ganache_url)
+
+# seconds to wait for ganache to initialize
+_CONNECT_TIMEOUT = 30
+
+# seconds between reads of the contract's upload events
+_LOG_POLL_INTERVAL = 1
+
+# seconds a resumed round waits for an upload sent before the client stopped
+_RESUME_TIMEOUT = 120
 
 # network description
-num_receivables = 50
+num_receivables = int(os.environ.get('RECEIVABLES_DEBTORS', 50))
 num_shares = 20
 min_num_shares = 10
 
+# processes generating shares, 1 generates them in this process
+num_workers = int(os.environ.get('RECEIVABLES_WORKERS', 1))
+
+# seed of the shares, so a run's shares are the same whatever the number of
+# workers, unset for random shares
+# For simulation only: anyone with the seed can regenerate each debtor's
+# polynomial and read their balance from a single share
+share_seed = os.environ.get('RECEIVABLES_SEED')
+if share_seed is not None:
+    share_seed = int(share_seed)
+
+# set RECEIVABLES_COMPARE_GAS to estimate the gas of uploading ID 0's shares
+# with and without packing before a new round's uploads
+compare_gas = bool(os.environ.get('RECEIVABLES_COMPARE_GAS'))
+
+# format of the share exports, 'csv' or 'columnar' binary files that can
+# be memory mapped
+export_format = os.environ.get('RECEIVABLES_EXPORT', 'csv')
+
+# file to write the run's stage timings, chain call latencies and gas
+# used to, a .prom file for the Prometheus node exporter textfile collector
+# or otherwise JSON, unset to not collect them
+metrics_file = os.environ.get('RECEIVABLES_METRICS')
+
+# journal of the current round, a round that stopped partway through
+# uploading is resumed from it on the next run
+journal_file = os.environ.get('RECEIVABLES_JOURNAL', 'receivables_journal.jsonl')
+
 # 12th Mersenne Prime
 # (for this application of Shamir [1979] we want a known prime number as close as
 # possible to our security level; e.g.  desired security level of 128
@@ -80,6 +132,29 @@ _PRIME = 2 ** 127 - 1
 
 _RINT = functools.partial(random.SystemRandom().randint, 0)
 
+# number of debtors whose shares are generated together by share_balances,
+# and in each partition handed to a worker by aggregate_parallel
+_BATCH_SIZE = 4096
+
+_MASK64 = 2 ** 64 - 1
+
+# number of upLoadShares transactions waiting to be mined at any one time
+_MAX_IN_FLIGHT = 16
+
+# number of eth_call requests sent in a single JSON-RPC batch
+_RPC_BATCH_SIZE = 500
+
+# debtor keys are derived from this seed when there are more debtors than
+# node accounts, they are for test networks only
+_KEY_POOL_SEED = 'receivablesSum debtor'
+
+# gas allowed for each address registered by setReceivables, and for the
+# transaction plus each [x, y, num] triplet in upLoadShares
+_SET_RECEIVABLE_GAS = 30000
+_TRANSFER_GAS = 21000
+_TX_GAS = 60000
+_TRIPLET_GAS = 50000
+
 
 def _eval_at(poly, x, prime):
     """Evaluates polynomial (coefficient tuple) at x, used to generate a
@@ -110,6 +185,73 @@ def make_random_shares(secret, minimum, shares, prime=_PRIME):
     return points
 
 
+def _random_coeffs(count, prime=_PRIME, rng=None):
+    """Draws count random integers in [0, prime) from a single os.urandom
+    call rather than one SystemRandom call per coefficient. If rng is given
+    they are drawn from it instead, for reproducible simulations only.
+    """
+    bits = prime.bit_length()
+    if rng is not None:
+        coeffs = []
+        while len(coeffs) < count:
+            coeff = rng.getrandbits(bits)
+            if coeff < prime:
+                coeffs.append(coeff)
+        return coeffs
+
+    width = (bits + 7) // 8
+    mask = (1 << bits) - 1
+    coeffs = []
+    while len(coeffs) < count:
+        buf = os.urandom((count - len(coeffs)) * width)
+        for i in range(0, len(buf), width):
+            coeff = int.from_bytes(buf[i:i + width], 'big') & mask
+            if coeff < prime:
+                coeffs.append(coeff)
+    return coeffs
+
+
+@functools.lru_cache(maxsize=None)
+def _x_powers(shares, degree, prime):
+    """Table of x**j mod prime for x = 1..shares and j = 0..degree-1.
+    Row x-1 dotted with a coefficient list gives the polynomial at x.
+    """
+    return tuple(tuple(pow(x, j, prime) for j in range(degree))
+                 for x in range(1, shares + 1))
+
+
+def _eval_batch(polys, shares, prime=_PRIME):
+    """Evaluates every polynomial (coefficient lists of equal length) at
+    x = 1..shares. Returns a list of share point lists, one per polynomial,
+    matching what _eval_at gives point by point.
+    """
+    if not polys:
+        return []
+    table = _x_powers(shares, len(polys[0]), prime)
+    return [[(x, sum(map(operator.mul, poly, powers)) % prime)
+             for x, powers in enumerate(table, 1)]
+            for poly in polys]
+
+
+def make_random_shares_batch(secrets, minimum, shares, prime=_PRIME, rng=None):
+    """
+    Generates a random shamir pool for each secret in one pass, returns a
+    list of share point lists in the same order as secrets. Coefficients
+    come from rng if given (see _random_coeffs).
+    """
+    if minimum > shares:
+        raise ValueError("Pool secret would be irrecoverable.")
+
+    secrets = list(secrets)
+    # make_random_shares draws minimum - 1 coefficients and overwrites the
+    # first with the secret, keep the same polynomial shape here.
+    width = max(minimum - 2, 0)
+    coeffs = _random_coeffs(len(secrets) * width, prime, rng)
+    polys = [[secret] + coeffs[i * width:(i + 1) * width]
+             for i, secret in enumerate(secrets)]
+    return _eval_batch(polys, shares, prime)
+
+
 def _extended_gcd(a, b):
     """
     Division in integers modulus p means finding the inverse of the
@@ -166,6 +308,42 @@ def _lagrange_interpolate(x, x_s, y_s, p):
     return (_divmod(num, den, p) + p) % p
 
 
+@functools.lru_cache(maxsize=1024)
+def _lagrange_weights(x_s, prime):
+    """
+    Lagrange basis weights at x = 0 for the sorted x values x_s, so the
+    intercept is sum(w * y) % prime. Everything is reduced mod prime as it
+    is built and all the denominators are inverted with a single
+    _extended_gcd call.
+    """
+    k = len(x_s)
+    assert k == len(set(x_s)), "points must be distinct"
+
+    nums = []
+    dens = []
+    for i, cur in enumerate(x_s):
+        num = 1
+        den = 1
+        for j, o in enumerate(x_s):
+            if j != i:
+                num = num * -o % prime
+                den = den * (cur - o) % prime
+        nums.append(num)
+        dens.append(den)
+    # prefix[i] is the product of dens[:i], invert the full product once
+    # and peel each denominator's inverse off it working backwards
+    prefix = [1]
+    for den in dens:
+        prefix.append(prefix[-1] * den % prime)
+    inv, _ = _extended_gcd(prefix[-1], prime)
+    inv %= prime
+    weights = [0] * k
+    for i in reversed(range(k)):
+        weights[i] = nums[i] * prefix[i] % prime * inv % prime
+        inv = inv * dens[i] % prime
+    return tuple(weights)
+
+
 def recover_secret(shares, prime=_PRIME):
     """
     Recover the secret from share points
@@ -174,55 +352,970 @@ def recover_secret(shares, prime=_PRIME):
     """
     if len(shares) < 2:
         raise ValueError("need at least two shares")
-    x_s, y_s = zip(*shares)
-    return _lagrange_interpolate(0, x_s, y_s, prime)
-
-
-def initialize_blockchain(_name, _date, _bal, _prime, _shares, _min_shares):
-    """ Initialize blockchain and load descriptive data
-        Return smart contract object and contract address """
+    x_s, y_s = zip(*sorted(shares))
+    weights = _lagrange_weights(x_s, prime)
+    return sum(map(operator.mul, weights, y_s)) % prime
 
-    if web3.isConnected() == True:
-        print('Connected to Blockchain at', ganache_url)
-    else:
-        print('Not connected to Blockchain')
-        exit()
-
-    # Set first Ethereum account as sender ('owner')
-    web3.eth.defaultAccount = web3.eth.accounts[0]
-
-    # Get bytecode - taken from compiler in Remix
-    bytecode = '0x608060405234801561001057600080fd5b5033600660006101000a81548173ffffffffffffffffffffffffffffffffffffffff021916908373ffffffffffffffffffffffffffffffffffffffff16021790555060008060030160046101000a81548163ffffffff021916908363ffffffff160217905550611067806100856000396000f300608060405260043610610083576000357c0100000000000000000000000000000000000000000000000000000000900463ffffffff1680632de41bd9146100885780635c74d7ed146100e35780637284e4161461014957806380d5010c146102cb578063832ef39414610331578063c2f055da14610379578063fe48e55214610462575b600080fd5b34801561009457600080fd5b506100c9600480360381019080803573ffffffffffffffffffffffffffffffffffffffff1690602001909291905050506104c8565b604051808215151515815260200191505060405180910390f35b3480156100ef57600080fd5b50610124600480360381019080803573ffffffffffffffffffffffffffffffffffffffff169060200190929190505050610521565b6040518083151515158152602001821515151581526020019250505060405180910390f35b34801561015557600080fd5b5061015e61055f565b604051808973ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff16815260200180602001806020018863ffffffff1663ffffffff1681526020018763ffffffff1663ffffffff1681526020018681526020018563ffffffff1663ffffffff1681526020018463ffffffff1663ffffffff16815260200183810383528a818151815260200191508051906020019080838360005b83811015610222578082015181840152602081019050610207565b50505050905090810190601f16801561024f5780820380516001836020036101000a031916815260200191505b50838103825289818151815260200191508051906020019080838360005b8381101561028857808201518184015260208101905061026d565b50505050905090810190601f1680156102b55780820380516001836020036101000a031916815260200191505b509a505050505050505050505060405180910390f35b3480156102d757600080fd5b5061032f60048036038101908080359060200190820180359060200190808060200260200160405190810160405280939291908181526020018383602002808284378201915050505050509192919290505050610725565b005b34801561033d57600080fd5b5061035c60048036038101908080359060200190929190505050610c84565b604051808381526020018281526020019250505060405180910390f35b34801561038557600080fd5b50610460600480360381019080803590602001908201803590602001908080601f0160208091040260200160405190810160405280939291908181526020018383808284378201915050505050509192919290803590602001908201803590602001908080601f0160208091040260200160405190810160405280939291908181526020018383808284378201915050505050509192919290803563ffffffff16906020019092919080359060200190929190803563ffffffff169060200190929190803563ffffffff169060200190929190505050610ca8565b005b34801561046e57600080fd5b506104c660048036038101908080359060200190820180359060200190808060200260200160405190810160405280939291908181526020018383602002808284378201915050505050509192919290505050610e1b565b005b6000600760008373ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff16815260200190815260200160002060000160009054906101000a900460ff169050919050565b60076020528060005260406000206000915090508060000160009054906101000a900460ff16908060000160019054906101000a900460ff16905082565b60008060000160009054906101000a900473ffffffffffffffffffffffffffffffffffffffff1690806001018054600181600116156101000203166002900480601f01602080910402602001604051908101604052809291908181526020018280546001816001161561010002031660029004801561061f5780601f106105f45761010080835404028352916020019161061f565b820191906000526020600020905b81548152906001019060200180831161060257829003601f168201915b505050505090806002018054600181600116156101000203166002900480601f0160208091040260200160405190810160405280929190818152602001828054600181600116156101000203166002900480156106bd5780601f10610692576101008083540402835291602001916106bd565b820191906000526020600020905b8154815290600101906020018083116106a057829003601f168201915b5050505050908060030160009054906101000a900463ffffffff16908060030160049054906101000a900463ffffffff16908060040154908060050160009054906101000a900463ffffffff16908060050160049054906101000a900463ffffffff16905088565b61072d610f7c565b600060011515600760003373ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff16815260200190815260200160002060000160009054906101000a900460ff1615151415156107fa576040517f08c379a000000000000000000000000000000000000000000000000000000000815260040180806020018281038252601a8152602001807f53656e646572206973206e6f7420612072656365697661626c6500000000000081525060200191505060405180910390fd5b6001600760003373ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff16815260200190815260200160002060000160016101000a81548160ff021916908315150217905515156108ee576040517f08c379a00000000000000000000000000000000000000000000000000000000081526004018080602001828103825260268152602001807f52656365697661626c652068617320616c72656164792075706c6f616465642081526020017f736861726573000000000000000000000000000000000000000000000000000081525060400191505060405180910390fd5b6002600060050160009054906101000a900463ffffffff1663ffffffff16101515156109a8576040517f08c379a00000000000000000000000000000000000000000000000000000000081526004018080602001828103825260298152602001807f436f6e7472616374206465736372697074696f6e2064617461206973206e6f7481526020017f20636f6d706c657465000000000000000000000000000000000000000000000081525060400191505060405180910390fd5b6000600384518115156109b757fe5b06141515610a53576040517f08c379a000000000000000000000000000000000000000000000000000000000815260040180806020018281038252603b8152602001807f536861726573206172726179206973206e6f74206d616465207570206f66206181526020017f206d756c7469706c65206f6620746872656520656c656d656e7473000000000081525060400191505060405180910390fd5b600090505b8251811015610c2457600060050160009054906101000a900463ffffffff1663ffffffff168382815181101515610a8b57fe5b9060200190602002015111151515610b31576040517f08c379a00000000000000000000000000000000000000000000000000000000081526004018080602001828103825260338152602001807f5368617265207820706f696e74206973206772656174686572207468656e207481526020017f6865206e756d626572206f66207368617265730000000000000000000000000081525060400191505060405180910390fd5b8260018201815181101515610b4257fe5b90602001906020020151600860008584815181101515610b5e57fe5b90602001906020020151815260200190815260200160002060000154018260000181815250508260028201815181101515610b9557fe5b90602001906020020151600860008584815181101515610bb157fe5b906020019060200201518152602001908152602001600020600101540182602001818152505081600860008584815181101515610bea57fe5b9060200190602002015181526020019081526020016000206000820151816000015560208201518160010155905050600381019050610a58565b6001600760003373ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff16815260200190815260200160002060000160016101000a81548160ff021916908315150217905550505050565b60086020528060005260406000206000915090508060000154908060010154905082565b600660009054906101000a900473ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff163373ffffffffffffffffffffffffffffffffffffffff16141515610d0457600080fd5b600660009054906101000a900473ffffffffffffffffffffffffffffffffffffffff166000800160006101000a81548173ffffffffffffffffffffffffffffffffffffffff021916908373ffffffffffffffffffffffffffffffffffffffff1602179055508560006001019080519060200190610d82929190610f96565b508460006002019080519060200190610d9c929190610f96565b5083600060030160006101000a81548163ffffffff021916908363ffffffff1602179055508260006004018190555081600060050160006101000a81548163ffffffff021916908363ffffffff16021790555080600060050160046101000a81548163ffffffff021916908363ffffffff160217905550505050505050565b6000600660009054906101000a900473ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff163373ffffffffffffffffffffffffffffffffffffffff16141515610e7957600080fd5b600090505b8151811015610f78576001600760008484815181101515610e9b57fe5b9060200190602002015173ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff16815260200190815260200160002060000160006101000a81548160ff0219169083151502179055506000600760008484815181101515610f0d57fe5b9060200190602002015173ffffffffffffffffffffffffffffffffffffffff1673ffffffffffffffffffffffffffffffffffffffff16815260200190815260200160002060000160016101000a81548160ff0219169083151502179055508080600101915050610e7e565b5050565b604080519081016040528060008152602001600081525090565b828054600181600116156101000203166002900490600052602060002090601f016020900481019282601f10610fd757805160ff1916838001178555611005565b82800160010185558215611005579182015b82811115611004578251825591602001919060010190610fe9565b5b5090506110129190611016565b5090565b61103891905b8082111561103457600081600090555060010161101c565b5090565b905600a165627a7a723058207f15a50a2002579c81ce89b63198c2b60fce884b341a030749b3892ff7ca86190029'
-
-    # Get abi - taken from comiler in Remix
-    abi = json.loads('[{"constant":true,"inputs":[{"name":"_address","type":"address"}],"name":"checkReceivable","outputs":[{"name":"","type":"bool"}],"payable":false,"stateMutability":"view","type":"function"},{"constant":true,"inputs":[{"name":"","type":"address"}],"name":"receivables_mapping","outputs":[{"name":"exists","type":"bool"},{"name":"uploaded_shares","type":"bool"}],"payable":false,"stateMutability":"view","type":"function"},{"constant":true,"inputs":[],"name":"description","outputs":[{"name":"owner","type":"address"},{"name":"name","type":"string"},{"name":"date","type":"string"},{"name":"assert_balance","type":"uint32"},{"name":"sum_balance","type":"uint32"},{"name":"prime","type":"uint256"},{"name":"shares","type":"uint32"},{"name":"min_shares","type":"uint32"}],"payable":false,"stateMutability":"view","type":"function"},{"constant":false,"inputs":[{"name":"_shares","type":"uint256[]"}],"name":"upLoadShares","outputs":[],"payable":false,"stateMutability":"nonpayable","type":"function"},{"constant":true,"inputs":[{"name":"","type":"uint256"}],"name":"cum_points","outputs":[{"name":"y","type":"uint256"},{"name":"number","type":"uint256"}],"payable":false,"stateMutability":"view","type":"function"},{"constant":false,"inputs":[{"name":"_name","type":"string"},{"name":"_date","type":"string"},{"name":"_assert_balance","type":"uint32"},{"name":"_prime","type":"uint256"},{"name":"_shares","type":"uint32"},{"name":"_min_shares","type":"uint32"}],"name":"setDescription","outputs":[],"payable":false,"stateMutability":"nonpayable","type":"function"},{"constant":false,"inputs":[{"name":"_addresses","type":"address[]"}],"name":"setReceivables","outputs":[],"payable":false,"stateMutability":"nonpayable","type":"function"},{"inputs":[],"payable":false,"stateMutability":"nonpayable","type":"constructor"}]')
-    receivablessumContract = web3.eth.contract(abi=abi, bytecode=bytecode)
-
-    # Submit the transaction that deploys the contract
-    tx_hash = receivablessumContract.constructor().transact()
 
-    # Wait for the transaction to be mined, and get the transaction receipt
-    tx_receipt = web3.eth.waitForTransactionReceipt(tx_hash)
-
-    # Assign the deployed smart contract to the rec_sum contract object and save the contract address
-    rec_sum = web3.eth.contract(address=tx_receipt.contractAddress, abi=abi)
-    contract_address = tx_receipt.contractAddress
-    print('Contract is deployed and is at address:', tx_receipt.contractAddress)
-
-    # Load the inital date onto the smart contract
-    tx_hash = rec_sum.functions.setDescription(
-        _name, _date, _bal, _prime, _shares, _min_shares).transact()
-    tx_receipt = web3.eth.waitForTransactionReceipt(tx_hash)
-    print('Contract description has been loaded')
-
-    # Load receivables addresses into the smart contract.
-    tx_hash = rec_sum.functions.setReceivables(
-        web3.eth.accounts[1:]).transact()
-    tx_receipt = web3.eth.waitForTransactionReceipt(tx_hash)
-    print('Debtors addresses have been uploaded to the blockchain')
-
-    # Return the contract object and the contract address
-    return rec_sum, contract_address
+def recover_many(share_sets, prime=_PRIME):
+    """
+    Recover a secret from each list of share points in share_sets. Share
+    sets using the same x values reuse the cached Lagrange weights.
+    """
+    return [recover_secret(shares, prime) for shares in share_sets]
+
+
+class Metrics(object):
+    """ Timings, gas used and counts collected over a run
+        Stages are timed in wall clock and CPU seconds and chain calls in
+        wall clock seconds, with the number of calls that raised. When not
+        enabled nothing is recorded"""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = {}
+        self.calls = {}
+        self.gas = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def stage(self, name):
+        """ Return a context manager timing the stage name """
+        if not self.enabled:
+            return _NOT_TIMED
+        return self._timed(self.stages, name, cpu=True)
+
+    def call(self, name):
+        """ Return a context manager timing a chain call name """
+        if not self.enabled:
+            return _NOT_TIMED
+        # process CPU time is not recorded for calls, as calls made
+        # concurrently from upload threads would each count all of it
+        return self._timed(self.calls, name, cpu=False)
+
+    @contextlib.contextmanager
+    def _timed(self, table, name, cpu):
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            seconds = time.perf_counter() - start
+            cpu_seconds = time.process_time() - cpu_start
+            with self._lock:
+                entry = table.setdefault(name, {'count': 0, 'errors': 0, 'seconds': 0.0,
+                                                'max_seconds': 0.0})
+                entry['count'] += 1
+                entry['errors'] += error
+                entry['seconds'] += seconds
+                entry['max_seconds'] = max(entry['max_seconds'], seconds)
+                if cpu:
+                    entry['cpu_seconds'] = entry.get('cpu_seconds', 0.0) + cpu_seconds
+
+    def add_gas(self, name, gas):
+        """ Record the gasUsed of a name transaction """
+        if not self.enabled:
+            return
+        with self._lock:
+            entry = self.gas.setdefault(name, {'count': 0, 'gas': 0, 'max_gas': 0})
+            entry['count'] += 1
+            entry['gas'] += gas
+            entry['max_gas'] = max(entry['max_gas'], gas)
+
+    def count(self, name, n=1):
+        """ Add n to the counter name """
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def summary(self):
+        """ Return the collected metrics as a dict """
+        with self._lock:
+            return json.loads(json.dumps({'stages': self.stages, 'calls': self.calls,
+                                          'gas': self.gas, 'counts': self.counts}))
+
+    def prometheus(self):
+        """ Return the collected metrics in the Prometheus text format """
+        summary = self.summary()
+        lines = []
+        metrics = [('stage_seconds', 'stages', 'stage', 'seconds'),
+                   ('stage_cpu_seconds', 'stages', 'stage', 'cpu_seconds'),
+                   ('call_seconds_sum', 'calls', 'call', 'seconds'),
+                   ('call_seconds_count', 'calls', 'call', 'count'),
+                   ('call_seconds_max', 'calls', 'call', 'max_seconds'),
+                   ('call_errors_total', 'calls', 'call', 'errors'),
+                   ('gas_used_sum', 'gas', 'transaction', 'gas'),
+                   ('gas_used_count', 'gas', 'transaction', 'count'),
+                   ('gas_used_max', 'gas', 'transaction', 'max_gas')]
+        for metric, table, label, key in metrics:
+            if summary[table]:
+                lines.append('# TYPE receivables_%s gauge' % metric)
+            for name, entry in sorted(summary[table].items()):
+                lines.append('receivables_%s{%s="%s"} %r' % (metric, label, name, entry[key]))
+        if summary['counts']:
+            lines.append('# TYPE receivables_events_total counter')
+        for name, value in sorted(summary['counts'].items()):
+            lines.append('receivables_events_total{event="%s"} %d' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """ Write the metrics to path, in the Prometheus text format if it
+            ends in .prom and otherwise as JSON
+            The file is replaced in one step so collectors never read it
+            half written"""
+        if path.endswith('.prom'):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.summary(), indent=2)
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
+
+
+_NOT_TIMED = contextlib.nullcontext()
+
+# metrics of this run, collected if metrics_file is set
+metrics = Metrics(enabled=bool(metrics_file))
+
+
+def derive_debtor_keys(n, seed=_KEY_POOL_SEED):
+    """ Derive n debtor key pairs deterministically from seed
+        Return a list of eth_account LocalAccount objects"""
+    return [Account.from_key(Web3.keccak(text='%s:%d' % (seed, i)))
+            for i in range(n)]
+
+
+def _upload_gas(triplets):
+    """ Gas limit for an upLoadShares transaction of triplets [x, y, num] """
+    return _TX_GAS + _TRIPLET_GAS * triplets
+
+
+def pack_shares(shares):
+    """ Pack a flat list of [x, y, num] triplets into one word per share
+        as x << 192 | num << 128 | y for upLoadPackedShares
+        Return the list of packed words"""
+    packed = []
+    for i in range(0, len(shares), 3):
+        x, y, num = shares[i:i + 3]
+        if y >> 128 or num >> 64 or x >> 64:
+            raise ValueError("share does not fit in a packed word")
+        packed.append(x << 192 | num << 128 | y)
+    return packed
+
+
+def unpack_shares(packed):
+    """ Return the flat list of [x, y, num] triplets in packed words """
+    shares = []
+    for word in packed:
+        shares.extend((word >> 192, word & (2 ** 128 - 1),
+                       word >> 128 & _MASK64))
+    return shares
+
+
+def upload_shares(rec_sum, accounts, payloads, max_in_flight=_MAX_IN_FLIGHT,
+                  keys=None, packed=False, on_receipt=None, ids=None,
+                  on_send=None, resend_nonces=None):
+    """ Upload each debtor's aggregated shares from the debtor's account
+        payloads are for debtors 0, 1, ... or for the debtors in ids.
+        Transactions are sent concurrently with at most max_in_flight
+        waiting to be mined, and nonces are tracked locally per sender.
+        resend_nonces maps debtor ids to the nonce of an earlier upload
+        that was lost, which is sent again with the same nonce so that only
+        one of the two can be mined.
+        If keys are given (in the same order as accounts) transactions are
+        signed locally and sent raw, otherwise the node signs them.
+        If packed the shares are sent packed to upLoadPackedShares.
+        on_send(id, nonce, tx_hash) is called before each upload is sent,
+        with tx_hash None if the node signs it, and again with the hash
+        once the node has returned it. on_receipt(id, shares, receipt) is
+        called as each upload is mined. Both are called from a worker thread.
+        Return a dict of receipts and a dict of failures keyed by debtor id"""
+    w3 = rec_sum.web3
+    if keys is not None:
+        chain_id = w3.eth.chainId
+        gas_price = w3.eth.gasPrice
+    nonces = {}
+    lock = threading.Lock()
+    resend_nonces = resend_nonces or {}
+    # new nonces of a sender start after any nonce being sent again
+    reserved = {}
+    for id, nonce in resend_nonces.items():
+        reserved[accounts[id]] = max(reserved.get(accounts[id], 0), nonce + 1)
+
+    def next_nonce(account):
+        with lock:
+            known = account in nonces
+        if not known:
+            with metrics.call('getTransactionCount'):
+                count = w3.eth.getTransactionCount(account, 'pending')
+            with lock:
+                nonces.setdefault(account, max(count, reserved.get(account, 0)))
+        with lock:
+            nonce = nonces[account]
+            nonces[account] += 1
+        return nonce
+
+    def upload(id, shares):
+        account = accounts[id]
+        if packed:
+            function = rec_sum.functions.upLoadPackedShares(pack_shares(shares))
+        else:
+            function = rec_sum.functions.upLoadShares(shares)
+        try:
+            if id in resend_nonces:
+                nonce = resend_nonces[id]
+            else:
+                nonce = next_nonce(account)
+            tx = {'from': account, 'nonce': nonce}
+            if keys is None:
+                if on_send is not None:
+                    on_send(id, nonce, None)
+                with metrics.call('sendTransaction'):
+                    tx_hash = function.transact(tx)
+                if on_send is not None:
+                    on_send(id, nonce, tx_hash)
+            else:
+                tx.update({'gas': _upload_gas(len(shares) // 3), 'gasPrice': gas_price,
+                           'chainId': chain_id})
+                tx = function.buildTransaction(tx)
+                signed = Account.sign_transaction(tx, keys[id].key)
+                if on_send is not None:
+                    on_send(id, nonce, signed.hash)
+                with metrics.call('sendRawTransaction'):
+                    tx_hash = w3.eth.sendRawTransaction(signed.rawTransaction)
+        except Exception:
+            # the nonce may not have been used, read it from the node again
+            with lock:
+                nonces.pop(account, None)
+            metrics.count('nonce_resyncs')
+            raise
+        with metrics.call('waitForTransactionReceipt'):
+            tx_receipt = w3.eth.waitForTransactionReceipt(tx_hash)
+        metrics.add_gas(function.fn_name, tx_receipt.gasUsed)
+        if tx_receipt.status == 0:
+            raise ValueError('upload transaction reverted')
+        return tx_receipt
+
+    receipts = {}
+    failures = {}
+    slots = threading.BoundedSemaphore(max_in_flight)
+
+    def collect(id, shares, future):
+        try:
+            receipts[id] = future.result()
+        except Exception as e:
+            failures[id] = e
+            metrics.count('upload_failures')
+        else:
+            metrics.count('uploads')
+            if on_receipt is not None:
+                on_receipt(id, shares, receipts[id])
+        finally:
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        for id, shares in zip(itertools.count() if ids is None else ids, payloads):
+            slots.acquire()
+            future = pool.submit(upload, id, shares)
+            future.add_done_callback(functools.partial(collect, id, shares))
+    return receipts, failures
+
+
+def _eth_call_batch(w3, calls):
+    """ Send a list of eth_call transactions to the node as JSON-RPC batch
+        requests of up to _RPC_BATCH_SIZE calls each
+        Return the raw return data of each call in order"""
+    if not isinstance(w3.provider, Web3.HTTPProvider):
+        # only HTTP nodes take batches, ask other providers one at a time
+        results = []
+        for tx in calls:
+            with metrics.call('eth_call'):
+                results.append(w3.eth.call(tx))
+        return results
+
+    results = []
+    for start in range(0, len(calls), _RPC_BATCH_SIZE):
+        batch = [{'jsonrpc': '2.0', 'id': id, 'method': 'eth_call',
+                  'params': [tx, 'latest']}
+                 for id, tx in enumerate(calls[start:start + _RPC_BATCH_SIZE])]
+        with metrics.call('eth_call_batch'):
+            response = requests.post(w3.provider.endpoint_uri, json=batch,
+                                     **dict(w3.provider.get_request_kwargs()))
+            response.raise_for_status()
+        replies = response.json()
+        if isinstance(replies, dict):
+            # the node rejected the whole batch with a single error object
+            raise ValueError(replies.get('error', replies))
+        # replies to a batch may come back in any order, but there must be
+        # exactly one for each call or results would pair with other calls
+        replies = sorted(replies, key=lambda reply: reply['id'])
+        if [reply['id'] for reply in replies] != list(range(len(batch))):
+            raise ValueError('eth_call batch of %d calls got %d replies that do '
+                             'not match the call ids' % (len(batch), len(replies)))
+        for reply in replies:
+            if 'error' in reply:
+                raise ValueError(reply['error'])
+            results.append(HexBytes(reply['result']))
+    return results
+
+
+def download_cum_points(rec_sum, num_shares):
+    """ Read the aggregated point for each x = 1..num_shares from the
+        cum_points mapping in as few requests as possible
+        Return a list of [x, y] ready for recover_secret"""
+    w3 = rec_sum.web3
+    calls = [{'to': rec_sum.address,
+              'data': rec_sum.encodeABI(fn_name='cum_points', args=[x])}
+             for x in range(1, num_shares + 1)]
+    results = _eth_call_batch(w3, calls)
+    return [[x, w3.codec.decode_abi(['uint256', 'uint256'], data)[0]]
+            for x, data in enumerate(results, 1)]
+
+
+def upload_status(rec_sum, accounts):
+    """ Read each account's entry in the receivables_mapping in as few
+        requests as possible
+        Return a list of uploaded_shares flags in the same order"""
+    w3 = rec_sum.web3
+    calls = [{'to': rec_sum.address,
+              'data': rec_sum.encodeABI(fn_name='receivables_mapping',
+                                        args=[account])}
+             for account in accounts]
+    results = _eth_call_batch(w3, calls)
+    return [w3.codec.decode_abi(['bool', 'bool'], data)[1] for data in results]
+
+
+class CumPointsTracker(object):
+    """ Running copy of the contract's cum_points, fed by upload events
+        An x point is complete when all n debtors' shares at x have been
+        added, and the total can be recovered once min_shares x points are
+        complete, without waiting for the remaining uploads"""
+
+    def __init__(self, n, shares, min_shares):
+        self.n = n
+        # recover_secret needs at least two points
+        self.min_shares = max(min_shares, 2)
+        self.y = [0] * (shares + 1)
+        self.number = [0] * (shares + 1)
+        self.complete = []
+        self.uploads = 0
+        self.secret = None
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+
+    def add(self, shares):
+        """ Add the flat list of [x, y, num] triplets of one upload """
+        with self._lock:
+            self.uploads += 1
+            for i in range(0, len(shares), 3):
+                x = shares[i]
+                self.y[x] += shares[i + 1]
+                self.number[x] += shares[i + 2]
+                if self.number[x] == self.n:
+                    self.complete.append(x)
+                    print('Aggregated share at x = %d is complete after %d uploads, '
+                          '%d of %d x points complete (%d needed)'
+                          % (x, self.uploads, len(self.complete), len(self.y) - 1,
+                             self.min_shares))
+            if self.secret is None and self.ready():
+                self.secret = recover_secret(
+                    self.points()[:self.min_shares])
+                print('Total recovered after', self.uploads, 'of', self.n,
+                      'uploads:', self.secret)
+                self._ready.set()
+
+    def ready(self):
+        """ Return True once min_shares x points are complete """
+        return len(self.complete) >= self.min_shares
+
+    def wait(self, timeout=None):
+        """ Wait up to timeout seconds for min_shares x points to complete
+            Return ready()"""
+        return self._ready.wait(timeout)
+
+    def points(self):
+        """ Return [x, y] for each complete x point, ready for recover_secret """
+        return [[x, self.y[x]] for x in sorted(self.complete)]
+
+
+class RoundJournal(object):
+    """ Append only journal of a confirmation round, one JSON record a line
+        A round record (the contract address and description) is followed
+        by each debtor's aggregated payload, a record with the nonce of each
+        upload before it is sent (with its transaction hash, once known), a
+        record as each upload is mined and a complete record once the round is finished, so a round
+        that stopped partway can be resumed on the same contract"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _records(self):
+        """ Yield each record in the journal """
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        # a line torn by a crash, or the blank line
+                        # written when the journal was reopened
+                        continue
+        except FileNotFoundError:
+            return
+
+    def unfinished(self):
+        """ Return the round record if the journal holds a round that was
+            not completed, otherwise None"""
+        first = last = None
+        for record in self._records():
+            if first is None:
+                first = record
+            last = record
+        if first is None or first['record'] != 'round' or last['record'] == 'complete':
+            return None
+        return first
+
+    def count(self, kind):
+        """ Return the number of records of a kind """
+        return sum(1 for record in self._records() if record['record'] == kind)
+
+    def payloads(self, ids=None):
+        """ Yield the journaled payloads of every debtor, or of the debtors
+            in ids, in debtor id order"""
+        wanted = None if ids is None else set(ids)
+        for record in self._records():
+            if record['record'] == 'payload' and (wanted is None or record['id'] in wanted):
+                yield record['shares']
+
+    def unsettled(self):
+        """ Return the uploads journaled as sent but not as mined
+            as a dict of (nonce, tx hash) by debtor id"""
+        sent = {}
+        for record in self._records():
+            if record['record'] == 'sent':
+                sent[record['id']] = (record['nonce'], record['tx_hash'])
+            elif record['record'] == 'uploaded':
+                sent.pop(record['id'], None)
+        return sent
+
+    def uploaded(self):
+        """ Return the set of debtor ids with an upload journaled """
+        return {record['id'] for record in self._records()
+                if record['record'] == 'uploaded'}
+
+    def start(self, **round):
+        """ Start a new journal holding only the round record """
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+            self._file = open(self.path, 'w')
+        round['record'] = 'round'
+        self.append(round, sync=True)
+
+    def append(self, record, sync=False):
+        """ Append a record, and if sync wait until it is on disk """
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+                # end a line torn by a crash so it does not swallow this one
+                self._file.write('\n')
+            self._file.write(line)
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def sync(self):
+        """ Wait until all the appended records are on disk """
+        with self._lock:
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class LedgerError(Exception):
+    """ Raised when the simulated contract rejects a transaction """
+
+
+# Get abi and bytecode - compiled from ReceivablesSum.sol with solc 0.4.26
+# by Receivable_Sum_Contract_Build.py
+_CONTRACT_ARTIFACT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  'ReceivablesSum.json')
+
+
+def load_contract(path=_CONTRACT_ARTIFACT):
+    """ Return the ABI and bytecode of the compiled contract """
+    try:
+        with open(path) as f:
+            artifact = json.load(f)
+    except FileNotFoundError:
+        raise FileNotFoundError(
+            path + ' not found, compile ReceivablesSum.sol with'
+            ' python Receivable_Sum_Contract_Build.py')
+    return artifact['abi'], artifact['bytecode']
+
+
+class Web3Ledger(object):
+    """ receivablesSum contract deployed on an Ethereum node through web3
+        The owner is the node's first account and the n debtors the next n,
+        or all the rest if n is None, or if n debtors are more than the node
+        has a pool of n locally held keys funded by the owner"""
+
+    def __init__(self, w3, n=None):
+        self.web3 = w3
+        self.url = getattr(w3.provider, 'endpoint_uri', w3.provider)
+        self.abi, self.bytecode = load_contract()
+        self.rec_sum = None
+        self.deployed_block = 0
+        self.keys = None
+        self.packed = False
+        self.events = False
+        # Wait for ganache to initialize
+        deadline = time.time() + _CONNECT_TIMEOUT
+        while not w3.isConnected() and time.time() < deadline:
+            metrics.count('connect_retries')
+            time.sleep(1)
+        node_accounts = w3.eth.accounts if w3.isConnected() else []
+        if n is None:
+            self.accounts = node_accounts[1:]
+        elif n < len(node_accounts):
+            self.accounts = node_accounts[1:n + 1]
+        else:
+            self.keys = derive_debtor_keys(n)
+            self.accounts = [key.address for key in self.keys]
+
+    def initialize_blockchain(self, _name, _date, _bal, _prime, _shares, _min_shares):
+        """ Initialize blockchain and load descriptive data
+            Return contract address """
+        web3 = self.web3
+
+        if web3.isConnected() == True:
+            print('Connected to Blockchain at', self.url)
+        else:
+            print('Not connected to Blockchain')
+            exit()
+
+        # Set first Ethereum account as sender ('owner')
+        web3.eth.defaultAccount = web3.eth.accounts[0]
+
+        # Make sure the owner can fund the debtor key pool before deploying
+        if self.keys is not None:
+            self._check_owner_funds(_upload_gas(_shares))
+
+        receivablessumContract = web3.eth.contract(
+            abi=self.abi, bytecode=self.bytecode)
+
+        # Submit the transaction that deploys the contract
+        with metrics.call('sendTransaction'):
+            tx_hash = receivablessumContract.constructor().transact()
+
+        # Wait for the transaction to be mined, and get the transaction receipt
+        tx_receipt = self._wait(tx_hash, 'deploy')
+
+        # Assign the deployed smart contract to the rec_sum contract object and save the contract address
+        self.rec_sum = web3.eth.contract(address=tx_receipt.contractAddress, abi=self.abi)
+        contract_address = tx_receipt.contractAddress
+        self.deployed_block = tx_receipt.blockNumber
+        print('Contract is deployed and is at address:', tx_receipt.contractAddress)
+        self._detect_features(contract_address)
+
+        # Load the inital date onto the smart contract
+        with metrics.call('sendTransaction'):
+            tx_hash = self.rec_sum.functions.setDescription(
+                _name, _date, _bal, _prime, _shares, _min_shares).transact()
+        tx_receipt = self._wait(tx_hash, 'setDescription')
+        print('Contract description has been loaded')
+
+        # Give locally held debtor keys enough ether to pay for their uploads
+        if self.keys is not None:
+            self.fund_accounts(_upload_gas(_shares))
+            print('Debtors accounts have been funded')
+
+        # Load receivables addresses into the smart contract.
+        self.set_receivables(self.accounts)
+        print('Debtors addresses have been uploaded to the blockchain')
+
+        # Return the contract address
+        return contract_address
+
+    def genesis_hash(self):
+        """ Return the hash of the node's genesis block, which identifies
+            the chain across restarts of the client"""
+        return self.web3.eth.getBlock(0).hash.hex()
+
+    def attach(self, contract_address, deployed_block=0, genesis_hash=None):
+        """ Use the contract already deployed at contract_address in block
+            deployed_block, with its description and receivables loaded by
+            initialize_blockchain, on the chain with genesis_hash if given
+            Return contract address, or None if the node is on another chain
+            or has no contract at that address"""
+        web3 = self.web3
+        if not web3.isConnected():
+            print('Not connected to Blockchain')
+            exit()
+        if genesis_hash is not None and genesis_hash != self.genesis_hash():
+            return None
+        if not web3.eth.getCode(contract_address):
+            return None
+        web3.eth.defaultAccount = web3.eth.accounts[0]
+        self.rec_sum = web3.eth.contract(address=contract_address, abi=self.abi)
+        self.deployed_block = deployed_block
+        self._detect_features(contract_address)
+        print('Using the contract at address:', contract_address)
+        return contract_address
+
+    def _detect_features(self, contract_address):
+        """ Check the deployed bytecode for the functions and events added
+            since the original contract"""
+        code = self.web3.eth.getCode(contract_address)
+        # Use packed uploads if the deployed bytecode has upLoadPackedShares
+        selector = Web3.keccak(text='upLoadPackedShares(uint256[])')[:4]
+        self.packed = selector in code
+        # and follow uploads from their logs if it emits SharesUploaded
+        self.events = Web3.keccak(text='SharesUploaded(address,uint256[])') in code
+
+    def _wait(self, tx_hash, name, timeout=120):
+        """ Wait for a name transaction to be mined and record its gas
+            Return the receipt"""
+        with metrics.call('waitForTransactionReceipt'):
+            tx_receipt = self.web3.eth.waitForTransactionReceipt(tx_hash, timeout)
+        metrics.add_gas(name, tx_receipt.gasUsed)
+        return tx_receipt
+
+    def _send_from_owner(self, txs, name):
+        """ Send name transactions from the owner account with consecutive
+            nonces without waiting in between, then wait for them all to be
+            mined
+            Return the receipts"""
+        web3 = self.web3
+        owner = web3.eth.accounts[0]
+        with metrics.call('getTransactionCount'):
+            nonce = web3.eth.getTransactionCount(owner, 'pending')
+        tx_hashes = []
+        for tx in txs:
+            tx.update({'from': owner, 'nonce': nonce})
+            with metrics.call('sendTransaction'):
+                tx_hashes.append(web3.eth.sendTransaction(tx))
+            nonce += 1
+        return [self._wait(tx_hash, name) for tx_hash in tx_hashes]
+
+    def _check_owner_funds(self, gas):
+        """ Exit if the owner cannot pay to register every debtor and fund
+            each with gas for an upload"""
+        web3 = self.web3
+        owner = web3.eth.accounts[0]
+        needed = (len(self.accounts) * (gas + _TRANSFER_GAS + _SET_RECEIVABLE_GAS)
+                  * web3.eth.gasPrice)
+        balance = web3.eth.getBalance(owner)
+        if balance < needed:
+            print('The owner account has', Web3.fromWei(balance, 'ether'),
+                  'ether but registering and funding', len(self.accounts),
+                  'debtors needs', Web3.fromWei(needed, 'ether'),
+                  'ether, start ganache with a larger --defaultBalanceEther')
+            exit()
+
+    def fund_accounts(self, gas):
+        """ Send each debtor account enough ether for gas at the node's price """
+        value = gas * self.web3.eth.gasPrice
+        self._send_from_owner(({'to': account, 'value': value}
+                               for account in self.accounts), 'fund')
+
+    def set_receivables(self, addresses):
+        """ Register addresses as receivables from the owner account
+            in chunks that fit in the block gas limit"""
+        gas_limit = self.web3.eth.getBlock('latest').gasLimit
+        chunk = max((gas_limit - _TX_GAS) // _SET_RECEIVABLE_GAS, 1)
+        txs = []
+        for start in range(0, len(addresses), chunk):
+            chunk_addresses = addresses[start:start + chunk]
+            txs.append({'to': self.rec_sum.address,
+                        'data': self.rec_sum.encodeABI(
+                            fn_name='setReceivables', args=[chunk_addresses]),
+                        'gas': _TX_GAS + _SET_RECEIVABLE_GAS * len(chunk_addresses)})
+        return self._send_from_owner(txs, 'setReceivables')
+
+    def upload_shares(self, payloads, on_upload=None, ids=None, on_send=None,
+                      resend_nonces=None):
+        """ Upload each debtor's upLoadShares payload from their account,
+            payloads are for debtors 0, 1, ... or for the debtors in ids
+            on_send(id, nonce, tx_hash) is called before each upload is sent,
+            and again with the hash if the node signs it, and
+            on_upload(id, shares) as each upload is mined.
+            resend_nonces maps debtor ids to the nonce to send them with
+            Return a dict of receipts and a dict of failures by debtor id"""
+        on_receipt = None if on_upload is None else (
+            lambda id, shares, tx_receipt: on_upload(id, shares))
+        return upload_shares(self.rec_sum, self.accounts, payloads,
+                             keys=self.keys, packed=self.packed,
+                             on_receipt=on_receipt, ids=ids, on_send=on_send,
+                             resend_nonces=resend_nonces)
+
+    def settle_uploads(self, sent, timeout=_RESUME_TIMEOUT):
+        """ Wait for uploads sent before the client stopped to be mined
+            sent maps debtor ids to the (nonce, tx hash) of their upload, the
+            hash is None if the client stopped before the node returned it
+            Return a dict of nonces by debtor id of the uploads without a
+            hash, that the node does not know of or that were not mined
+            within timeout, to be sent again with the same nonce. If the
+            first was sent after all, only one of the two can be mined"""
+        name = 'upLoadPackedShares' if self.packed else 'upLoadShares'
+        lost = {}
+        for id, (nonce, tx_hash) in sorted(sent.items()):
+            if tx_hash is not None:
+                try:
+                    # the node has forgotten a transaction it was sent, if
+                    # it restarted or dropped it from its pool
+                    self.web3.eth.getTransaction(tx_hash)
+                    self._wait(tx_hash, name, timeout)
+                    continue
+                except (TransactionNotFound, TimeExhausted):
+                    pass
+            lost[id] = nonce
+        return lost
+
+    def follow_uploads(self, callback, from_block=None, poll=_LOG_POLL_INTERVAL):
+        """ Call callback(shares) from a background thread with the [x, y, num]
+            triplets of every upload the contract logs from from_block, the
+            block it was deployed in by default, whoever sent it
+            Return a function that stops following once the uploads logged
+            so far have been passed to callback, or None if the deployed
+            contract does not log its uploads"""
+        if not self.events:
+            return None
+        web3 = self.web3
+        events = self.rec_sum.events
+        decoders = {
+            Web3.keccak(text='SharesUploaded(address,uint256[])').hex():
+                lambda log: list(events.SharesUploaded().processLog(log).args.shares),
+            Web3.keccak(text='PackedSharesUploaded(address,uint256[])').hex():
+                lambda log: unpack_shares(
+                    events.PackedSharesUploaded().processLog(log).args.shares)}
+        next_block = [self.deployed_block if from_block is None else from_block]
+        # (transaction hash, log index) of the logs from next_block already
+        # passed to callback, so a poll that fails part way through does not
+        # pass them again when it is retried
+        delivered = set()
+
+        def fetch():
+            latest = web3.eth.blockNumber
+            if latest < next_block[0]:
+                return
+            with metrics.call('getLogs'):
+                logs = web3.eth.getLogs({'address': self.rec_sum.address,
+                                         'fromBlock': next_block[0], 'toBlock': latest,
+                                         'topics': [list(decoders)]})
+            for log in logs:
+                key = (HexBytes(log['transactionHash']), log['logIndex'])
+                if key in delivered:
+                    continue
+                callback(decoders[HexBytes(log['topics'][0]).hex()](log))
+                delivered.add(key)
+            next_block[0] = latest + 1
+            delivered.clear()
+
+        stop = threading.Event()
+
+        def follow():
+            while True:
+                stopping = stop.is_set()
+                try:
+                    fetch()
+                except Exception as e:
+                    # try again at the next poll
+                    metrics.count('log_poll_errors')
+                    print('Reading upload events failed:', e)
+                if stopping:
+                    return
+                stop.wait(poll)
+
+        thread = threading.Thread(target=follow, daemon=True)
+        thread.start()
+
+        def stop_following():
+            stop.set()
+            thread.join()
+        return stop_following
+
+    def compare_upload_gas(self, id, shares):
+        """ Estimate the gas and calldata size of debtor id uploading shares
+            with upLoadShares and with upLoadPackedShares
+            The estimate is made at a gas price of 0 so it does not depend on
+            the debtor's balance, and is only meaningful before the debtor
+            has uploaded, while the cum_points slots are unset
+            Return a dict of (gas, calldata bytes) by function name, gas is
+            None if the deployed contract does not have the function"""
+        formats = {'upLoadShares': shares,
+                   'upLoadPackedShares': pack_shares(shares)}
+        comparison = {}
+        for name, args in formats.items():
+            data = self.rec_sum.encodeABI(fn_name=name, args=[args])
+            gas = None
+            if name == 'upLoadShares' or self.packed:
+                gas = self.web3.eth.estimateGas(
+                    {'from': self.accounts[id], 'to': self.rec_sum.address,
+                     'data': data, 'gasPrice': 0})
+            comparison[name] = (gas, len(HexBytes(data)))
+        return comparison
+
+    def download_cum_points(self, num_shares):
+        """ Return [x, y] from cum_points for x = 1..num_shares """
+        return download_cum_points(self.rec_sum, num_shares)
+
+    def upload_status(self):
+        """ Return the uploaded_shares flag of each debtor """
+        return upload_status(self.rec_sum, self.accounts)
+
+
+class SimulatedLedger(object):
+    """ In memory stand in for the receivablesSum contract
+        Transactions get the same isOwner, isReceivable and x range checks
+        as ReceivablesSum.sol and raise LedgerError where it would revert.
+        Uploads are sent packed as the simulator has upLoadPackedShares"""
+
+    def __init__(self, n):
+        self.owner = '0x%040x' % 0
+        self.accounts = ['0x%040x' % i for i in range(1, n + 1)]
+        self.description = {}
+        self.receivables_mapping = {}
+        self.cum_points = {}
+        self.deployed_block = 0
+        self._followers = []
+
+    def _is_owner(self, sender):
+        if sender != self.owner:
+            raise LedgerError('Sender is not the owner')
+
+    def _is_receivable(self, sender):
+        receivable = self.receivables_mapping.get(sender)
+        if receivable is None or not receivable[0]:
+            raise LedgerError('Sender is not a receivable')
+        # the contract assigns uploaded_shares = true here rather than
+        # comparing it, so a second upload is not rejected either
+
+    def initialize_blockchain(self, _name, _date, _bal, _prime, _shares, _min_shares):
+        """ Initialize the simulated contract and load descriptive data
+            Return contract address """
+        print('Running the smart contract in memory')
+        self.description = {'owner': self.owner, 'name': _name, 'date': _date,
+                            'assert_balance': _bal, 'sum_balance': 0,
+                            'prime': _prime, 'shares': _shares,
+                            'min_shares': _min_shares}
+        self.set_receivables(self.accounts)
+        print('Debtors addresses have been loaded')
+        return '0x%040x' % 0
+
+    def genesis_hash(self):
+        """ Return None as the simulated contract is not on a chain """
+        return None
+
+    def set_receivables(self, addresses, sender=None):
+        """ Register addresses as receivables, sent by the owner by default """
+        self._is_owner(self.owner if sender is None else sender)
+        for address in addresses:
+            self.receivables_mapping[address] = [True, False]
+
+    def upLoadShares(self, sender, shares):
+        """ Add a flat list of [x, y, num] triplets to cum_points """
+        self._is_receivable(sender)
+        if self.description.get('shares', 0) < 2:
+            raise LedgerError('Contract description data is not complete')
+        if len(shares) % 3 != 0:
+            raise LedgerError(
+                'Shares array is not made up of a multiple of three elements')
+        for i in range(0, len(shares), 3):
+            if shares[i] > self.description['shares']:
+                raise LedgerError('Share x point is > the number of shares')
+        # checks pass for the whole array before any state changes, as a
+        # revert would undo the updates
+        self._add_points(sender, shares)
+
+    def upLoadPackedShares(self, sender, packed):
+        """ Add shares packed one per word as x << 192 | num << 128 | y """
+        self._is_receivable(sender)
+        if self.description.get('shares', 0) < 2:
+            raise LedgerError('Contract description data is not complete')
+        shares = unpack_shares(packed)
+        for i in range(0, len(shares), 3):
+            if shares[i] > self.description['shares']:
+                raise LedgerError('Share x point is > the number of shares')
+        self._add_points(sender, shares)
+
+    def _add_points(self, sender, shares):
+        for i in range(0, len(shares), 3):
+            point = self.cum_points.setdefault(shares[i], [0, 0])
+            # uint256 arithmetic wraps
+            point[0] = (point[0] + shares[i + 1]) % 2 ** 256
+            point[1] = (point[1] + shares[i + 2]) % 2 ** 256
+        self.receivables_mapping[sender][1] = True
+        # the contract's upload events
+        for callback in self._followers:
+            callback(shares)
+
+    def upload_shares(self, payloads, on_upload=None, ids=None, on_send=None,
+                      resend_nonces=None):
+        """ Upload each debtor's upLoadShares payload from their account,
+            payloads are for debtors 0, 1, ... or for the debtors in ids
+            on_upload(id, shares) is called as each upload is made.
+            Uploads are made at once so there are no nonces, and on_send and
+            resend_nonces are not used
+            Return a dict of receipts and a dict of failures by debtor id"""
+        receipts = {}
+        failures = {}
+        for id, shares in zip(itertools.count() if ids is None else ids, payloads):
+            try:
+                self.upLoadPackedShares(self.accounts[id], pack_shares(shares))
+                receipts[id] = {'status': 1}
+            except (LedgerError, IndexError, ValueError) as e:
+                failures[id] = e
+                metrics.count('upload_failures')
+                continue
+            metrics.count('uploads')
+            if on_upload is not None:
+                on_upload(id, shares)
+        return receipts, failures
+
+    def follow_uploads(self, callback, from_block=None):
+        """ Call callback(shares) with the [x, y, num] triplets of every
+            upload from now on, whoever sent it
+            Return a function that stops following"""
+        self._followers.append(callback)
+        return functools.partial(self._followers.remove, callback)
+
+    def download_cum_points(self, num_shares):
+        """ Return [x, y] from cum_points for x = 1..num_shares """
+        return [[x, self.cum_points.get(x, [0, 0])[0]]
+                for x in range(1, num_shares + 1)]
+
+    def upload_status(self):
+        """ Return the uploaded_shares flag of each debtor """
+        return [self.receivables_mapping.get(account, [False, False])[1]
+                for account in self.accounts]
+
+
+def connect_ledger(backend=None, n=None):
+    """ Connect to the ledger backend named by backend, ledger_backend by
+        default, with n debtors
+        Return the ledger object"""
+    backend = backend or ledger_backend
+    if backend == 'web3':
+        if Web3 is None:
+            raise ImportError('web3 is needed for the web3 ledger backend')
+        return Web3Ledger(Web3(Web3.HTTPProvider(ganache_url)), n)
+    if backend == 'simulator':
+        return SimulatedLedger(num_receivables if n is None else n)
+    raise ValueError('Unknown ledger backend ' + backend)
 
 
 def create_network(n):
@@ -235,151 +1328,508 @@ def create_network(n):
     return bal
 
 
-def share_balances(bal_ls, m, s):
+def schedule_distribution(n, s, rng=None, owners=None):
+    """ Schedule the distribution of shares for a network of n debtors
+        Yield (owner, share_to_keep, recipients) for each debtor in owners
+        (all of them by default), where recipients are s-1 other debtors
+        chosen at random in O(s)"""
+    rng = rng or random
+    for owner in range(n) if owners is None else owners:
+        # pick a share for the owner to keep
+        share_to_keep = rng.randint(0, s-1)
+        # sample from 0..n-2 and step over the owner, this is the same draw
+        # as sampling a list of all debtors with the owner taken out
+        recipients = [no + (no >= owner)
+                      for no in rng.sample(range(n - 1), s-1)]
+        yield owner, share_to_keep, recipients
+
+
+def distribute_shares(bal_ls, m, s, rng=None, n=None, first=0, coeff_rng=None):
+    """ Create shares of each debtors balance and pick who receives them
+        Yield (owner, assignments) for each debtor, where assignments is a
+        list of (recipient, share) and the first share is kept by the owner
+        bal_ls may be a partition of a network of n debtors starting at
+        debtor first"""
+    n = len(bal_ls) if n is None else n
+    schedule = schedule_distribution(
+        n, s, rng, owners=range(first, first + len(bal_ls)))
+    for start in range(0, len(bal_ls), _BATCH_SIZE):
+        batch = make_random_shares_batch(
+            bal_ls[start:start + _BATCH_SIZE], minimum=m, shares=s,
+            rng=coeff_rng)
+        for shares_ls, (owner, share_to_keep, recipients) in zip(batch, schedule):
+            kept = shares_ls.pop(share_to_keep)
+            yield owner, [(owner, kept)] + list(zip(recipients, shares_ls))
+
+
+class ShareAccumulator(object):
+    """ Per debtor totals of the shares received at each x point
+        Slot debtor * shares + x - 1 holds the y sum mod prime, split into
+        two 64 bit words, and the number of shares received"""
+
+    def __init__(self, n, shares, prime=_PRIME):
+        if prime.bit_length() > 128:
+            raise ValueError("prime must fit in 128 bits")
+        self.n = n
+        self.shares = shares
+        self.prime = prime
+        self._lo = array.array('Q', bytes(8 * n * shares))
+        self._hi = array.array('Q', bytes(8 * n * shares))
+        self._num = array.array('I', bytes(4 * n * shares))
+
+    def add(self, debtor, share):
+        """ Add a share (x, y) received by a debtor """
+        x, y = share
+        if not 1 <= x <= self.shares:
+            raise ValueError("share x point is outside 1..shares")
+        self._add_slot(debtor * self.shares + x - 1, y, 1)
+
+    def merge(self, slots, ys, nums):
+        """ Add partial sums for a list of slots, with ys holding each y sum
+            as 16 big endian bytes and nums the number of shares """
+        for i, slot in enumerate(slots):
+            self._add_slot(slot, int.from_bytes(ys[16 * i:16 * i + 16], 'big'),
+                           nums[i])
+
+    def _add_slot(self, slot, y, num):
+        y = ((self._hi[slot] << 64 | self._lo[slot]) + y) % self.prime
+        self._lo[slot] = y & _MASK64
+        self._hi[slot] = y >> 64
+        self._num[slot] += num
+
+    def payload(self, debtor):
+        """ Return the upLoadShares payload for a debtor
+            a flat list of [x, y, num] for each x the debtor received"""
+        shares = []
+        slot = debtor * self.shares
+        for x in range(1, self.shares + 1):
+            if self._num[slot]:
+                shares.extend((x, self._hi[slot] << 64 | self._lo[slot],
+                               self._num[slot]))
+            slot += 1
+        return shares
+
+    def payloads(self, ids=None):
+        """ Yield the upLoadShares payload for each debtor, or each debtor
+            in ids, in order"""
+        for debtor in range(self.n) if ids is None else ids:
+            yield self.payload(debtor)
+
+
+def _partition_rng(seed, first):
+    """ Return the random numbers of the partition of debtors starting at
+        debtor first, which depend only on the seed and the partition, not
+        on which worker or how many workers run it"""
+    return random.Random('%d:%d' % (seed, first))
+
+
+def _seeded_distribution(bal_ls, m, s, seed):
+    """ Yield (owner, assignments) as distribute_shares does, for each
+        partition of _BATCH_SIZE debtors in turn with the partition's seeded
+        random numbers, so the shares are those of aggregate_parallel"""
+    n = len(bal_ls)
+    for first in range(0, n, _BATCH_SIZE):
+        rng = _partition_rng(seed, first)
+        for item in distribute_shares(bal_ls[first:first + _BATCH_SIZE], m, s,
+                                      rng, n=n, first=first, coeff_rng=rng):
+            yield item
+
+
+def _partition_shares(task):
+    """ Generate and distribute the shares of one partition of debtors,
+        run in a worker process by aggregate_parallel
+        Return the partition's partial sums as (slots, ys, nums) in the form
+        taken by ShareAccumulator.merge"""
+    first, bal_ls, n, m, s, seed = task
+    if seed is None:
+        rng = random.Random()
+        coeff_rng = None
+    else:
+        rng = coeff_rng = _partition_rng(seed, first)
+    partial = {}
+    for owner, assignments in distribute_shares(
+            bal_ls, m, s, rng, n=n, first=first, coeff_rng=coeff_rng):
+        for bal_no, (x, y) in assignments:
+            slot = bal_no * s + x - 1
+            y_sum, num = partial.get(slot, (0, 0))
+            partial[slot] = ((y_sum + y) % _PRIME, num + 1)
+    slots = sorted(partial)
+    return (array.array('Q', slots),
+            b''.join(partial[slot][0].to_bytes(16, 'big') for slot in slots),
+            array.array('I', (partial[slot][1] for slot in slots)))
+
+
+def aggregate_parallel(bal_ls, m, s, workers=None, seed=None):
+    """ Create and distribute shares of each debtors balance across a pool
+        of worker processes, each taking partitions of _BATCH_SIZE debtors
+        With a seed the result does not depend on the number of workers
+        Return a ShareAccumulator of the shares each debtor received"""
+    n = len(bal_ls)
+    acc = ShareAccumulator(n, s)
+    tasks = ((first, bal_ls[first:first + _BATCH_SIZE], n, m, s, seed)
+             for first in range(0, n, _BATCH_SIZE))
+    if workers == 1:
+        for partial in map(_partition_shares, tasks):
+            acc.merge(*partial)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for partial in pool.map(_partition_shares, tasks):
+                acc.merge(*partial)
+    return acc
+
+
+def share_balances(bal_ls, m, s, rng=None, acc=None, out=None, seed=None):
     """Create shares of each debtors balance and distribute to m other debtors
-     who are randomly chosen
-     Return a list of distributed shares"""
+     who are randomly chosen, the same shares as aggregate_parallel's with
+     the same seed if one is given
+     Return a list of distributed shares, also added to acc if given, or
+     if out is given write each share to it as a (debtor, x, y) row instead"""
     # Create a list of n empty lists to hold the shares. Shares will be in the same
     # order as bal_ls
     no_balances = len(bal_ls)
 
-    distributed_shares = [[] for _ in range(no_balances)]
+    distributed_shares = None
+    if out is None:
+        distributed_shares = [[] for _ in range(no_balances)]
     # go though balances and distribute shares to random other customers.
-    # print(distributed_shares)
 
     print('')
     print('Distributing shares to other debtors')
-    for count, bal in enumerate(bal_ls):
-        shares_ls = make_random_shares(bal, minimum=m, shares=s)
-        # pick a share for the owner to keep
-        share_to_keep = random.randint(0, s-1)
-        # distribute a random share back to owner
-        distributed_shares[count].append(shares_ls[share_to_keep])
-        del shares_ls[share_to_keep]
-        # pick a sample of other balances withoout duplicates and the ownwer of the shares
-        pickable = list(range(no_balances))
-        pickable.remove(count)  # take out owner from pickable list
-        sample = random.sample(pickable, s-1)
+    if seed is None:
+        distribution = distribute_shares(bal_ls, m, s, rng)
+    else:
+        distribution = _seeded_distribution(bal_ls, m, s, seed)
+    for count, assignments in distribution:
         print('\rCompany ID', count, 'will distribute shares to',
-              sample, '            ', end='')
-        for share_no, bal_no in enumerate(sample):
-            distributed_shares[bal_no].append(shares_ls[share_no])
-            # distribute share_no+1 as share_no 0 kept by owner
+              [bal_no for bal_no, _ in assignments[1:]], '            ', end='')
+        for bal_no, share in assignments:
+            if out is None:
+                distributed_shares[bal_no].append(share)
+            else:
+                out.writerow((bal_no,) + share)
+            if acc is not None:
+                acc.add(bal_no, share)
     print('')
     return distributed_shares
 
 
+class CsvShareWriter(object):
+    """ Write rows of shares to path.csv as they are produced, with a
+        header row naming the columns"""
+
+    def __init__(self, path, columns):
+        self.path = path + '.csv'
+        self._file = open(self.path, 'w')
+        self._writer = csv.writer(self._file, delimiter=',', lineterminator='\n')
+        self._writer.writerow([name for name, _ in columns])
+
+    def writerow(self, row):
+        self._writer.writerow(row)
+
+    def writerows(self, rows):
+        self._writer.writerows(rows)
+
+    def close(self):
+        self._file.close()
+
+
+class ColumnarShareWriter(object):
+    """ Write rows of shares to the directory path as they are produced,
+        one file per column of fixed width little endian unsigned integers
+        so each column can be memory mapped (e.g. a 16 byte y column as
+        numpy.memmap(file, dtype=('<u8', 2)) giving the low and high words)
+        schema.json records the columns and, once closed, the row count"""
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = columns
+        self.rows = 0
+        os.makedirs(path, exist_ok=True)
+        self._files = [open(os.path.join(path, name + '.bin'), 'wb')
+                       for name, _ in columns]
+        self._buffers = [bytearray() for _ in columns]
+        self._write_schema(None)
+
+    def _write_schema(self, rows):
+        schema = {'rows': rows, 'byteorder': 'little',
+                  'columns': [{'name': name, 'file': name + '.bin', 'bytes': width}
+                              for name, width in self.columns]}
+        with open(os.path.join(self.path, 'schema.json'), 'w') as f:
+            json.dump(schema, f, indent=2)
+
+    def writerow(self, row):
+        for buffer, (_, width), value in zip(self._buffers, self.columns, row):
+            # raises OverflowError if the value does not fit the column
+            buffer += value.to_bytes(width, 'little')
+        self.rows += 1
+        if self.rows % _BATCH_SIZE == 0:
+            self._flush()
+
+    def writerows(self, rows):
+        for row in rows:
+            self.writerow(row)
+
+    def _flush(self):
+        for f, buffer in zip(self._files, self._buffers):
+            f.write(buffer)
+            del buffer[:]
+
+    def close(self):
+        self._flush()
+        for f in self._files:
+            f.close()
+        self._write_schema(self.rows)
+
+
+def read_columnar(path):
+    """ Yield each row written by ColumnarShareWriter to the directory path,
+        reading the columns through memory maps"""
+    with open(os.path.join(path, 'schema.json')) as f:
+        schema = json.load(f)
+    with contextlib.ExitStack() as stack:
+        columns = []
+        for column in schema['columns']:
+            f = stack.enter_context(open(os.path.join(path, column['file']), 'rb'))
+            if schema['rows']:
+                columns.append((stack.enter_context(
+                    mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)), column['bytes']))
+        for row in range(schema['rows'] or 0):
+            yield tuple(int.from_bytes(data[row * width:(row + 1) * width], 'little')
+                        for data, width in columns)
+
+
+# columns of each export as (name, bytes in the columnar format), y is a
+# share mod _PRIME except in full_agg_shares where it is a uint256 sum
+ALL_SHARES_COLUMNS = [('debtor', 4), ('x', 4), ('y', 16)]
+AGG_SHARES_COLUMNS = [('debtor', 4), ('x', 4), ('y', 16), ('num', 4)]
+FULL_AGG_SHARES_COLUMNS = [('x', 4), ('y', 32)]
+
+
+def open_share_writer(path, columns, format=None):
+    """ Open a writer for rows of columns in format, export_format by
+        default, 'csv' writes path.csv and 'columnar' the directory path"""
+    format = format or export_format
+    if format == 'csv':
+        return CsvShareWriter(path, columns)
+    if format == 'columnar':
+        return ColumnarShareWriter(path, columns)
+    raise ValueError('Unknown export format ' + format)
+
+
+def payload_rows(payloads):
+    """ Yield a (debtor, x, y, num) row for each triplet in payloads """
+    for id, shares in enumerate(payloads):
+        for i in range(0, len(shares), 3):
+            yield (id, shares[i], shares[i + 1], shares[i + 2])
+
+
 def main():
 
-    # create a random network of cutomers balances in a list
-    bal_list = create_network(num_receivables)
-    bal_total = sum(bal_list)
-    print('Secret (sum of balances):                                                     ',
-          bal_total)
-
-    # Iniatilize Blockcahin and smart contract
-    rec_sum, contract_address = initialize_blockchain(
-        "Acme Corp", "31.12.19", bal_total, _PRIME, num_shares, min_num_shares)
-
-    # Generate Shamir [1979] shares of each debtor's balance and distribute
-    # shares to a randome slection of other debtors while keeping one share for
-    # themselves.
-    all_shares = share_balances(bal_list, 10, 20)
-
-    # Prepare data for upload to blockchain by summing the y values of shares where 2
-    # or more shares from the same x point have been recieved by a debtor.
-    # also count the number of shares
-
-    shares_flatten_list = []
-
-    for shares in all_shares:
-        shares_flatten_dict = {}
-        for (x, y) in shares:
-            if x in shares_flatten_dict.keys():
-                # return the value for that key or return default 0 (and create key)
-                shares_flatten_dict[x]['y'] = shares_flatten_dict.get(
-                    x, {}).get('y', 0) + y
-                # return the value for that key or return default 0 (and create key)
-                shares_flatten_dict[x]['num'] = shares_flatten_dict.get(
-                    x, {}).get('num', 0) + 1
-            else:
-                shares_flatten_dict[x] = {'y': y, 'num':  1}
+    print('Python Client initializing ...')
 
-        shares_flatten_list.append([[x, y['y'], y['num']]
-                                   for (x, y) in shares_flatten_dict.items()])
+    if share_seed is not None and ledger_backend != 'simulator':
+        print('RECEIVABLES_SEED makes the shares reproducible, which reveals the'
+              ' balances, and is only for the simulator')
+        exit()
 
-    print('')
-    print("Aggregating shares for each debtor")
-    shares_flat_list = []
-    for id, shares in enumerate(shares_flatten_list):
-        # for each companies shares flatten the lists for upload
-        shares_flat_list.append(
-            [item for sublist in shares for item in sublist])
-        print('\rAggregating shares for ID', id, end='')
-    print("")
+    # Resume the journaled round if it stopped partway through uploading.
+    # The contract state only outlives the client on a blockchain.
+    journal = RoundJournal(journal_file)
+    resumed = journal.unfinished()
+    if resumed is not None:
+        if (resumed['backend'] != 'web3' or ledger_backend != 'web3'
+                or resumed['num_receivables'] != num_receivables
+                or journal.count('payload') != num_receivables):
+            print('Journaled round in', journal_file, 'cannot be resumed')
+            resumed = None
+
+    ledger = None
+    if resumed is not None:
+        with metrics.stage('attach'):
+            ledger = connect_ledger(n=num_receivables)
+            contract_address = ledger.attach(resumed['contract_address'],
+                                             resumed.get('deployed_block', 0),
+                                             resumed.get('genesis_hash'))
+        if contract_address is None:
+            # e.g. ganache was restarted since the round was journaled
+            print('Journaled round in', journal_file,
+                  'is not on this blockchain, starting a new round')
+            resumed = None
+
+    if resumed is not None:
+        print('Resuming the round journaled in', journal_file)
+        bal_total = resumed['bal_total']
+        print('Secret (sum of balances):                                                     ',
+              bal_total)
+        # the payloads are read from the journal as they are needed
+        source = journal
+    else:
+        # create a random network of cutomers balances in a list
+        with metrics.stage('create_network'):
+            bal_list = create_network(num_receivables)
+        bal_total = sum(bal_list)
+        print('Secret (sum of balances):                                                     ',
+              bal_total)
+
+        # Iniatilize Blockcahin and smart contract
+        with metrics.stage('initialize_blockchain'):
+            if ledger is None:
+                ledger = connect_ledger(n=num_receivables)
+            contract_address = ledger.initialize_blockchain(
+                "Acme Corp", "31.12.19", bal_total, _PRIME, num_shares, min_num_shares)
+        journal.start(contract_address=contract_address, backend=ledger_backend,
+                      deployed_block=ledger.deployed_block,
+                      genesis_hash=ledger.genesis_hash(),
+                      num_receivables=num_receivables, num_shares=num_shares,
+                      min_num_shares=min_num_shares, bal_total=bal_total)
+
+        # Generate Shamir [1979] shares of each debtor's balance and distribute
+        # shares to a randome slection of other debtors while keeping one share for
+        # themselves.
+        # Each debtor's received shares are summed for upload to the blockchain as
+        # they are distributed, adding the y values of shares where 2 or more shares
+        # from the same x point have been recieved by a debtor and counting them.
+        with metrics.stage('share_distribution'):
+            if num_workers > 1:
+                print('')
+                print('Distributing shares to other debtors with', num_workers,
+                      'worker' if num_workers == 1 else 'workers')
+                # the workers only return each debtor's sums
+                print('The distributed shares are not written to all_shares')
+                acc = aggregate_parallel(bal_list, 10, 20, workers=num_workers,
+                                         seed=share_seed)
+            else:
+                # Write the shares to all_shares for analysis as they are distributed
+                acc = ShareAccumulator(num_receivables, num_shares)
+                with contextlib.closing(open_share_writer(
+                        'all_shares', ALL_SHARES_COLUMNS)) as out:
+                    share_balances(bal_list, 10, 20, acc=acc, out=out,
+                                   seed=share_seed)
+        # the payloads are built from the accumulator as they are needed
+        source = acc
+        with metrics.stage('journal'):
+            for id, shares in enumerate(acc.payloads()):
+                journal.append({'record': 'payload', 'id': id, 'shares': shares})
+            journal.sync()
+
+    # Write the aggregated shares to agg_shares for analysis
+    with metrics.stage('export'), contextlib.closing(open_share_writer(
+            'agg_shares', AGG_SHARES_COLUMNS)) as out:
+        out.writerows(payload_rows(source.payloads()))
 
     # Upload the aggregated shares to the blockchain.
     print("")
+    if compare_gas and resumed is None and isinstance(ledger, Web3Ledger):
+        try:
+            print('Gas and calldata bytes to upload the shares of ID 0:',
+                  ledger.compare_upload_gas(0, next(source.payloads([0]))))
+        except Exception as e:
+            # only informative, the round goes on without it
+            print('Upload gas comparison failed:', e)
     print("Uploading shares to the blockchain")
-    for id, shares in enumerate(shares_flat_list):
-        # Set debtors Ethereum account as sender
-        web3.eth.defaultAccount = web3.eth.accounts[id+1]
-        # construct transaction and send to blockchain
-        tx_hash = rec_sum.functions.upLoadShares(shares).transact()
-        tx_receipt = web3.eth.waitForTransactionReceipt(tx_hash)
-        print('\rShares for ID', id, 'have been uploaded to the Blockchain', end='')
+    # Follow the contract's upload events, whoever sends them, to recover
+    # the total as soon as enough x points are complete
+    tracker = CumPointsTracker(num_receivables, num_shares, min_num_shares)
+    stop_following = ledger.follow_uploads(tracker.add)
+    ids = range(num_receivables)
+    resend_nonces = None
+    if resumed is not None:
+        # Uploads sent before the round stopped are waited for, or sent
+        # again with the same nonce if they were lost, so none is counted
+        # twice
+        unsettled = journal.unsettled()
+        if unsettled:
+            print('Waiting for', len(unsettled), 'uploads sent before the round stopped')
+            resend_nonces = ledger.settle_uploads(unsettled)
+        # Debtors whose uploads were mined before the round stopped are
+        # read from the contract and only the rest are uploaded
+        uploaded = ledger.upload_status()
+        print(sum(uploaded), 'of', len(uploaded), 'debtors had uploaded shares,',
+              len(journal.uploaded()), 'uploads were journaled')
+        ids = [id for id in ids if not uploaded[id]]
+
+    def on_upload(id, shares):
+        if stop_following is None:
+            # the contract does not log uploads, follow this client's own
+            tracker.add(shares)
+        journal.append({'record': 'uploaded', 'id': id})
+
+    def on_send(id, nonce, tx_hash):
+        # on disk before sending, so a resumed round reuses the nonce
+        journal.append({'record': 'sent', 'id': id, 'nonce': nonce,
+                        'tx_hash': None if tx_hash is None else HexBytes(tx_hash).hex()},
+                       sync=True)
+
+    def confirm(shares_down, label='downloaded'):
+        print('Shares', label, shares_down)
+        print('')
+        with metrics.stage('recover_secret'):
+            secret_down = recover_secret(shares_down)
+        print('Secret recovered from shares', label, 'is', secret_down)
+        if bal_total == secret_down:
+            print('Sume of receivabales =', bal_total, 'is equal to ', secret_down)
+            print('\033[92mTest Suceeded\033[0m')
+            print('')
+        else:
+            print('Sume of receivabales =', bal_total,
+                  'is not equal to ', secret_down)
+            print('\033[91mTest Failed\033[0m')
+            print('')
+
+        min_list = random.sample(shares_down, min_num_shares)
+
+        print('Secret recovered from minimum number of shares',
+              recover_secret(min_list))
+
+    # Each debtor sends from their own Ethereum account
+    confirmed = False
+    with metrics.stage('upload'), ThreadPoolExecutor(max_workers=1) as uploader:
+        uploading = uploader.submit(ledger.upload_shares, source.payloads(ids),
+                                    on_upload=on_upload, ids=ids, on_send=on_send,
+                                    resend_nonces=resend_nonces)
+        # Confirm the total once the upload events have completed enough
+        # x points, while the remaining uploads are still being mined
+        while not uploading.done() and not tracker.wait(0.1):
+            pass
+        if tracker.ready():
+            print('')
+            print("Aggregated shares taken from the upload events")
+            confirm(tracker.points(), 'from the upload events')
+            confirmed = True
+        receipts, failures = uploading.result()
+    if stop_following is not None:
+        stop_following()
+    print('Shares for', len(receipts), 'debtors have been uploaded to the Blockchain')
+    for id, error in sorted(failures.items()):
+        print('Shares for ID', id, 'failed to upload:', error)
+    uploaded = ledger.upload_status()
+    print(sum(uploaded), 'of', len(uploaded), 'debtors have uploaded shares')
     print("")
 
-    # Download the fully aggregated shares (from all debtors) from the blockchain.
-    print("")
+    # Download the fully aggregated shares (from all debtors) from the blockchain,
+    # the upload events only give the x points complete when the total was confirmed
     print("Downloading shares from the blockchain")
-    shares_down = []
-    for id in range(1, num_shares+1):
-        # Send message to blockchain to retrieve aggregate shares
-        share = [id, rec_sum.functions.cum_points(id).call()[0]]
-        shares_down.append([id, rec_sum.functions.cum_points(id).call()[0]])
-        #print('\rShares for ID',id,'have been uploaded to the Blockchain',end='')
-    print("")
-    print('Shares downloaded', shares_down)
-
-    print('')
-    secret_down = recover_secret(shares_down)
-    print('Secret recovered from shares downloaded is', secret_down)
-    if bal_total == secret_down:
-        print('Sume of receivabales =', bal_total, 'is equal to ', secret_down)
-        print('\033[92mTest Suceeded\033[0m')
-        print('')
-    else:
-        print('Sume of receivabales =', bal_total,
-              'is not equal to ', secret_down)
-        print('\033[91mTest Failed\033[0m')
-        print('')
-
-    min_list = random.sample(shares_down, min_num_shares)
-
-    print('Secret recovered from minimum number of shares',
-          recover_secret(min_list))
-
-    # Write out shares
-
-    # Write the shares to a csv file for analysis
-    with open("all_shares.csv", 'w') as f:
-        # for shares in all_shares:
-        fc = csv.writer(f, delimiter=',', lineterminator='\n')
-        fc.writerows(all_shares)
+    with metrics.stage('download'):
+        shares_down = ledger.download_cum_points(num_shares)
+    if not confirmed:
+        print("")
+        confirm(shares_down)
 
-    # Write the aggregated shares to a csv file for analysis
-    with open("agg_shares.csv", 'w') as f:
-        # for shares in all_shares:
-        fc = csv.writer(f, delimiter=',', lineterminator='\n')
-        fc.writerows(shares_flat_list)
+    # Write the shares retrieved from the blockchain to full_agg_shares for analysis
+    with metrics.stage('export'), contextlib.closing(open_share_writer(
+            'full_agg_shares', FULL_AGG_SHARES_COLUMNS)) as out:
+        out.writerows(shares_down)
 
-    # Write the shares retrieved from the blockchain to a csv file for analysis
-    with open("full_agg_shares.csv", 'w') as f:
-        # for shares in all_shares:
-        fc = csv.writer(f, delimiter=',', lineterminator='\n')
-        fc.writerows(shares_down)
+    if not failures:
+        journal.append({'record': 'complete'}, sync=True)
+    journal.close()
 
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    finally:
+        # write the metrics of a run that failed too
+        if metrics.enabled:
+            metrics.write(metrics_file)
+            print('Metrics written to', metrics_file)
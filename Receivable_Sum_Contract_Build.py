@@ -0,0 +1,77 @@
+"""
+Compile ReceivablesSum.sol with solc 0.4.26 and write the contract's ABI
+and bytecode to ReceivablesSum.json, where the python client loads them.
+
+py-solc-x installs solc 0.4.26 the first time it is needed. The source is
+compiled through solc's standard JSON input under its file name, without
+the optimizer as in Remix, so the output does not depend on where the
+repository is checked out.
+
+$ pip install py-solc-x
+$ python Receivable_Sum_Contract_Build.py
+
+Run it with --check to confirm ReceivablesSum.json is the compiled source.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import sys
+
+import solcx
+
+SOLC_VERSION = '0.4.26'
+CONTRACT_NAME = 'receivablesSum'
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE = os.path.join(_HERE, 'ReceivablesSum.sol')
+ARTIFACT = os.path.join(_HERE, 'ReceivablesSum.json')
+
+
+def compile_contract():
+    """ Compile ReceivablesSum.sol
+        Return a dict of the compiler version, ABI and bytecode"""
+    if SOLC_VERSION not in [str(v) for v in solcx.get_installed_solc_versions()]:
+        solcx.install_solc(SOLC_VERSION)
+    with open(SOURCE) as f:
+        source = f.read()
+    name = os.path.basename(SOURCE)
+    output = solcx.compile_standard({
+        'language': 'Solidity',
+        'sources': {name: {'content': source}},
+        'settings': {'optimizer': {'enabled': False},
+                     'outputSelection': {'*': {'*': ['abi', 'evm.bytecode.object']}}},
+    }, solc_version=SOLC_VERSION)
+    contract = output['contracts'][name][CONTRACT_NAME]
+    return {'contractName': CONTRACT_NAME, 'compiler': 'solc ' + SOLC_VERSION,
+            'abi': contract['abi'],
+            'bytecode': '0x' + contract['evm']['bytecode']['object']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--check', action='store_true',
+                        help='check ReceivablesSum.json instead of writing it')
+    args = parser.parse_args()
+
+    artifact = compile_contract()
+    if args.check:
+        try:
+            with open(ARTIFACT) as f:
+                current = json.load(f)
+        except FileNotFoundError:
+            current = None
+        if current != artifact:
+            print(ARTIFACT, 'is not the compiled', SOURCE)
+            sys.exit(1)
+        print(ARTIFACT, 'is up to date')
+        return
+    with open(ARTIFACT, 'w') as f:
+        json.dump(artifact, f, indent=2)
+        f.write('\n')
+    print('Compiled', SOURCE, 'with solc', SOLC_VERSION, 'to', ARTIFACT)
+
+
+if __name__ == '__main__':
+    main()
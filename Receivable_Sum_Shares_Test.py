@@ -0,0 +1,72 @@
+""" Tests of batched share generation and cached secret recovery against
+    the point by point functions
+
+    % python -m unittest Receivable_Sum_Shares_Test
+"""
+import random
+import unittest
+
+import Receivable_Sum_Client_Test as rs
+
+
+class MakeRandomSharesBatchTest(unittest.TestCase):
+
+    def polys(self, secrets, minimum, seed):
+        """ The polynomials make_random_shares_batch builds from seed """
+        width = max(minimum - 2, 0)
+        coeffs = rs._random_coeffs(len(secrets) * width, rs._PRIME, random.Random(seed))
+        return [[secret] + coeffs[i * width:(i + 1) * width]
+                for i, secret in enumerate(secrets)]
+
+    def test_points_match_eval_at(self):
+        secrets = [0, 1, 999999, rs._PRIME - 1] + random.sample(range(1000, 1000000), 20)
+        for minimum, shares in [(10, 20), (2, 5), (3, 3)]:
+            batch = rs.make_random_shares_batch(secrets, minimum, shares,
+                                                rng=random.Random(minimum))
+            self.assertEqual(batch, [
+                [(x, rs._eval_at(poly, x, rs._PRIME)) for x in range(1, shares + 1)]
+                for poly in self.polys(secrets, minimum, minimum)])
+
+    def test_recovers_secrets(self):
+        secrets = random.sample(range(1000, 1000000), 5)
+        batch = rs.make_random_shares_batch(secrets, 10, 20)
+        self.assertEqual([rs._lagrange_interpolate(0, *zip(*points), rs._PRIME)
+                          for points in batch], secrets)
+
+    def test_irrecoverable_pool(self):
+        with self.assertRaises(ValueError):
+            rs.make_random_shares_batch([1], 5, 4)
+
+
+class RecoverSecretTest(unittest.TestCase):
+
+    def share_sets(self):
+        """ Share points of random pools, reduced and with the uint256 sized
+            y values of aggregated shares summed on the contract """
+        secrets = random.sample(range(1000, 1000000), 10)
+        for points in rs.make_random_shares_batch(secrets, 10, 20):
+            yield random.sample(points, 10)
+            yield random.sample(points, 20)
+            yield [(x, y + random.randrange(2 ** 128) * rs._PRIME) for x, y in points]
+        # y values that are not on any small polynomial
+        yield [(x, random.randrange(2 ** 256)) for x in random.sample(range(1, 100), 7)]
+
+    def test_matches_lagrange_interpolate(self):
+        for shares in self.share_sets():
+            x_s, y_s = zip(*shares)
+            self.assertEqual(rs.recover_secret(shares),
+                             rs._lagrange_interpolate(0, x_s, y_s, rs._PRIME))
+
+    def test_recover_many(self):
+        share_sets = list(self.share_sets())
+        self.assertEqual(rs.recover_many(share_sets),
+                         [rs._lagrange_interpolate(0, *zip(*shares), rs._PRIME)
+                          for shares in share_sets])
+
+    def test_too_few_shares(self):
+        with self.assertRaises(ValueError):
+            rs.recover_secret([(1, 5)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+""" Tests of upload_shares against the contract on an in-process chain
+
+    Needs the eth-tester backend of web3
+    % pip install "web3[tester]==5.12.0"
+    % python -m unittest Receivable_Sum_Upload_Test
+"""
+import contextlib
+import io
+import os
+import threading
+import unittest
+
+try:
+    import rlp
+    from eth_account import Account
+    from eth_tester import EthereumTester, PyEVMBackend
+    from web3 import EthereumTesterProvider, Web3
+except ImportError:
+    EthereumTester = None
+
+import Receivable_Sum_Client_Test as rs
+
+
+if EthereumTester is not None:
+    class _NodeTesterProvider(EthereumTesterProvider):
+        """ eth-tester taking requests one at a time, where a signed
+            transaction sent ahead of its sender's nonce waits up to a second
+            for the nonces before it, as a node's transaction pool would hold
+            it, before it is rejected
+            The first fail_sends eth_sendRawTransaction requests fail before
+            reaching the chain"""
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.mined = threading.Condition()
+            self.fail_sends = 0
+
+        def make_request(self, method, params):
+            with self.mined:
+                if method == 'eth_sendRawTransaction':
+                    if self.fail_sends:
+                        self.fail_sends -= 1
+                        raise ConnectionError('connection dropped')
+                    raw = Web3.toBytes(hexstr=params[0])
+                    sender = Account.recover_transaction(raw)
+                    nonce = int.from_bytes(rlp.decode(raw)[0], 'big')
+                    self.mined.wait_for(
+                        lambda: self.ethereum_tester.get_nonce(sender) >= nonce, 1)
+                response = super().make_request(method, params)
+                self.mined.notify_all()
+                return response
+
+
+def _chain(accounts):
+    """ Return a web3 connected to a new chain with funded accounts """
+    state = PyEVMBackend._generate_genesis_state(num_accounts=accounts)
+    return Web3(_NodeTesterProvider(EthereumTester(PyEVMBackend(genesis_state=state))))
+
+
+def _payload(id, shares):
+    """ A valid upLoadShares payload of one share at each x point """
+    return [v for x in range(1, shares + 1) for v in (x, 1000 * id + x, 1)]
+
+
+@unittest.skipIf(EthereumTester is None, 'eth-tester is not installed')
+@unittest.skipIf(not os.path.exists(rs._CONTRACT_ARTIFACT),
+                 'ReceivablesSum.json has not been compiled')
+class UploadSharesTest(unittest.TestCase):
+
+    def deploy(self, n):
+        """ Deploy the contract for n debtors with locally held keys, so
+            nonces are the client's and a reverting upload is mined"""
+        ledger = rs.Web3Ledger(_chain(2), n)
+        with contextlib.redirect_stdout(io.StringIO()):
+            ledger.initialize_blockchain('Acme Corp', '31.12.19', 0, rs._PRIME,
+                                         rs.num_shares, rs.min_num_shares)
+            # enough for the debtors to upload more than once
+            ledger.fund_accounts(4 * rs._upload_gas(rs.num_shares))
+        return ledger
+
+    def nonces(self, ledger, receipts):
+        """ Return the nonces used by each sender, in the order they were used """
+        sent = {}
+        for receipt in sorted(receipts.values(), key=lambda r: r.blockNumber):
+            tx = ledger.web3.eth.getTransaction(receipt.transactionHash)
+            sent.setdefault(tx['from'], []).append(tx.nonce)
+        return sent
+
+    def assertCumPoints(self, ledger, payloads):
+        y = {}
+        for shares in payloads:
+            for i in range(0, len(shares), 3):
+                y[shares[i]] = y.get(shares[i], 0) + shares[i + 1]
+        self.assertEqual(ledger.download_cum_points(rs.num_shares),
+                         [[x, y.get(x, 0)] for x in range(1, rs.num_shares + 1)])
+
+    def test_nonces_per_sender(self):
+        ledger = self.deploy(3)
+        # debtors 0..5 share the three accounts so each sends twice
+        accounts = ledger.accounts * 2
+        payloads = [_payload(id, rs.num_shares) for id in range(6)]
+        receipts, failures = rs.upload_shares(ledger.rec_sum, accounts, payloads,
+                                              max_in_flight=6, keys=ledger.keys * 2)
+        self.assertEqual(failures, {})
+        self.assertEqual(sorted(receipts), list(range(6)))
+        self.assertEqual(self.nonces(ledger, receipts),
+                         {account: [0, 1] for account in ledger.accounts})
+        self.assertCumPoints(ledger, payloads)
+
+    def test_failed_send_resyncs_nonce(self):
+        ledger = self.deploy(2)
+        accounts = ledger.accounts[:1] * 4
+        payloads = [_payload(id, rs.num_shares) for id in range(4)]
+        ledger.web3.provider.fail_sends = 1
+        receipts, failures = rs.upload_shares(ledger.rec_sum, accounts, payloads,
+                                              max_in_flight=1, keys=ledger.keys[:1] * 4)
+        # the nonce of the failed send is used by the next upload
+        self.assertEqual(list(failures), [0])
+        self.assertIsInstance(failures[0], ConnectionError)
+        self.assertEqual(sorted(receipts), [1, 2, 3])
+        self.assertEqual(self.nonces(ledger, receipts), {accounts[0]: [0, 1, 2]})
+        self.assertCumPoints(ledger, payloads[1:])
+
+    def test_reverted_upload_does_not_stall(self):
+        ledger = self.deploy(6)
+        payloads = [_payload(id, rs.num_shares) for id in range(6)]
+        payloads[2] = [rs.num_shares + 1, 1, 1]
+        receipts, failures = rs.upload_shares(ledger.rec_sum, ledger.accounts, payloads,
+                                              max_in_flight=2, keys=ledger.keys,
+                                              packed=ledger.packed)
+        self.assertEqual(list(failures), [2])
+        self.assertEqual(str(failures[2]), 'upload transaction reverted')
+        self.assertEqual(sorted(receipts), [0, 1, 3, 4, 5])
+        self.assertEqual(ledger.upload_status(), [True, True, False, True, True, True])
+        self.assertCumPoints(ledger, payloads[:2] + payloads[3:])
+
+
+if __name__ == '__main__':
+    unittest.main()
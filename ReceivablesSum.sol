@@ -1,4 +1,4 @@
-pragma solidity ^0.4.19;
+pragma solidity ^0.4.21;
 
 // Solidity Program to accumulate shares of an enity's debtors balances
 // onto an ethereum blockchain.
@@ -45,6 +45,10 @@ contract receivablesSum {
 
     mapping(uint256 => point) public cum_points;
 
+    //events so clients can follow cum_points without reading it back
+    event SharesUploaded(address indexed receivable, uint256[] shares);
+    event PackedSharesUploaded(address indexed receivable, uint256[] shares);
+
     //constructor function
     function receivablesSum() public {
         owner = msg.sender;
@@ -122,5 +126,31 @@ contract receivablesSum {
         }
         // set receivable data to uploaded
         receivables_mapping[msg.sender].uploaded_shares = true;
+        emit SharesUploaded(msg.sender, _shares);
+    }
+
+    function upLoadPackedShares(uint256[] _shares) public isReceivable {
+        //each share is packed into one word as x << 192 | number << 128 | y
+        //so y must be reduced below 2**128 before upload
+        uint32 shares = description.shares;
+        require(shares >= 2, "Contract description data is not complete");
+        uint256 x;
+        point memory temp_point;
+        for (uint256 i = 0; i < _shares.length; i++) {
+            x = _shares[i] >> 192;
+            //each share x value should be <= the total number of shares
+            require(x <= shares, "Share x point is > the number of shares");
+            //work out cumulative shares (y) for each point (x) and update cum_points mapping
+            temp_point.y =
+                cum_points[x].y +
+                (_shares[i] & 0xffffffffffffffffffffffffffffffff);
+            temp_point.number =
+                cum_points[x].number +
+                ((_shares[i] >> 128) & 0xffffffffffffffff);
+            cum_points[x] = temp_point;
+        }
+        // set receivable data to uploaded
+        receivables_mapping[msg.sender].uploaded_shares = true;
+        emit PackedSharesUploaded(msg.sender, _shares);
     }
 }